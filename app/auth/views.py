@@ -6,6 +6,7 @@ from ..models import User
 from ..email import send_email
 from .forms import LoginForm, ChangePasswordForm, PasswordResetRequestForm, PasswordResetForm, ChangeEmailForm, RegistrationForm
 from ..decorators import hr_required
+from ..pagination import paginate
 
 @auth.before_app_request
 def before_request():
@@ -18,6 +19,7 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data.lower()).first()
         if user is not None and user.verify_password(form.password.data):
+            db.session.commit()
             login_user(user, form.remember_me.data)
             next = request.args.get('next')
             if next is None or not next.startswith('/'):
@@ -124,11 +126,8 @@ def edit_user():
         return redirect(url_for('auth.edit_user'))
     edit_user_status = request.cookies.get('edit_user_status', '')
     if edit_user_status == '1':
-        page = request.args.get('page', 1, type=int)
-        query=User.query
-        pagination = query.order_by(User.id).paginate(
-                    page, per_page=current_app.config['FLASK_USER_PER_PAGE'],
-                    error_out=False)
+        pagination = paginate(User.query.options(db.selectinload(User.department).load_only('name')),
+                              [(User.id, False)], current_app.config['FLASK_USER_PER_PAGE'])
         users = pagination.items
         return render_template('auth/edit_user.html', edit_user_status=edit_user_status, users=users, pagination=pagination)
     return render_template('auth/edit_user.html', edit_user_status=edit_user_status, form=form)
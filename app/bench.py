@@ -0,0 +1,159 @@
+import os
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from . import create_app, db
+from .models import WorkOrHoliday, WorkCalendar, Time, OfficalLeave, LeaveLog, PasswordHasher
+
+
+# 假日表: first ~ last 年間每 4 天一筆事件，放假與補班交替。
+def holidays(first=2010, last=2030):
+    rows = []
+    day = datetime(first, 1, 1)
+    while day.year <= last:
+        rows.append({'start': day, 'end': day + timedelta(hours=23, minutes=59, seconds=59),
+                     'reason': 'bench', 'workday': len(rows) % 2})
+        day += timedelta(days=4)
+    return rows
+
+
+# 跨年度請假: 長度 0 ~ 3 年，起訖時間落在 09:00 ~ 18:00 的半小時。
+def leaves(count, rnd, first=2012, last=2027):
+    spans = []
+    for i in range(count):
+        start = datetime(first, 1, 1) + timedelta(days=rnd.randrange((last - first) * 365),
+                                                  hours=9, minutes=rnd.randrange(17) * 30)
+        end = start + timedelta(days=rnd.randrange(3 * 365), minutes=rnd.randrange(1, 3) * 30)
+        spans.append((start, end))
+    return spans
+
+
+# 到職日分布: 一萬名員工，到職日集中於近十年。
+def hire_dates(count, rnd):
+    return [datetime(2020, 12, 31) - timedelta(days=int(rnd.expovariate(1 / 2000.0)) % 12000)
+            for i in range(count)]
+
+
+def measure(f, args):
+    samples = []
+    for a in args:
+        t = time.perf_counter()
+        f(*a)
+        samples.append(time.perf_counter() - t)
+    samples.sort()
+    total = sum(samples)
+    return {
+        'ops': round(len(samples) / total, 1) if total else 0,
+        'p50': round(samples[len(samples) // 2] * 1e6, 2),
+        'p99': round(samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1e6, 2),
+    }
+
+
+def run(iterations=1000, seed=0):
+    rnd = random.Random(seed)
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        rows = holidays()
+        db.session.execute(WorkOrHoliday.__table__.insert(), rows)
+        WorkOrHoliday.on_changed(None, db.session, None, longest=max(r['end'] - r['start'] for r in rows))
+        db.session.commit()
+        spans = leaves(iterations, rnd)
+        dates = hire_dates(10000, rnd)
+        years = [rnd.randrange(2021, 2031) for d in dates]
+        WorkCalendar.snapshot(2010, 2030)
+        results = {}
+        results['Time.workingHours_days'] = measure(Time.workingHours_days, spans)
+        results['Time.dateInterval'] = measure(Time.dateInterval,
+                                               [(d, datetime(y, 1, 1)) for d, y in zip(dates, years)][:iterations])
+        OfficalLeave._newYear.cache_clear()
+        results['OfficalLeave.newYear'] = measure(OfficalLeave.newYear, list(zip(dates, years)))
+        results['LeaveLog.__init__'] = measure(lambda s, e: LeaveLog(start=s, end=e), spans)
+        db.session.remove()
+        db.drop_all()
+    results.update(holiday_lookups(count=iterations))
+    return results
+
+
+# 假日查詢: 事件表 (每 3 天一筆) 依序成長到 sizes 中的各個大小，每個大小量測 count 次
+# 表尾一個月範圍的 find_overlapping。表越大成本也不應隨之成長。
+def holiday_lookups(sizes=(200, 20000), count=100):
+    app = create_app('testing')
+    results = {}
+    with app.app_context():
+        db.create_all()
+        first = datetime(1990, 1, 1)
+        added = 0
+        for size in sizes:
+            rows = [{'start': first + timedelta(days=i*3), 'end': first + timedelta(days=i*3, hours=23, minutes=59),
+                     'reason': 'bench', 'workday': 0} for i in range(added, size)]
+            db.session.execute(WorkOrHoliday.__table__.insert(), rows)
+            WorkOrHoliday.on_changed(None, db.session, None, longest=max(r['end'] - r['start'] for r in rows))
+            db.session.commit()
+            added = size
+            day = first + timedelta(days=(size - 10) * 3)
+            results['WorkOrHoliday.find_overlapping[{}]'.format(size)] = measure(
+                lambda d: WorkOrHoliday.find_overlapping(d, d + timedelta(days=30)).all(), [(day,)] * count)
+        db.session.remove()
+        db.drop_all()
+    return results
+
+
+# 登入吞吐量: 以 threads 條執行緒模擬同時登入的請求，每個設定驗證 count 次密碼。
+# settings 為 (雜湊方法, 驗證行程數) 的序列，回傳每秒登入數。
+def logins(settings, count=100, threads=8):
+    app = create_app('testing')
+    results = {}
+    for method, workers in settings:
+        app.config.update(FLASK_PASSWORD_METHOD=method, FLASK_PASSWORD_WORKERS=workers)
+        app.extensions.pop('password_pool', None)
+        with app.app_context():
+            pwhash = PasswordHasher.hash('cat')
+
+        def login(i):
+            with app.app_context():
+                return PasswordHasher.verify(pwhash, 'cat')
+
+        with app.app_context():
+            login(0)
+        t = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            assert all(executor.map(login, range(count)))
+        elapsed = time.perf_counter() - t
+        pool = app.extensions.pop('password_pool', None)
+        if pool is not None:
+            pool.shutdown()
+        results['{} workers={}'.format(method, workers)] = round(count / elapsed, 1)
+    return results
+
+
+# 以 python -X importtime 在子行程中匯入 module，回傳 (總耗時秒數, [(模組, 自身秒數, 累計秒數)])。
+# 子行程不帶 FLASK_RUN_FROM_CLI 與 FLASK_COVERAGE，量到的是 worker 開機時的匯入成本。
+def import_times(module='flask_leave_system'):
+    env = dict(os.environ)
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    env.pop('FLASK_COVERAGE', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    total = next(cumulative for name, own, cumulative in modules if name == module)
+    return total, modules
+
+
+# 與基準比較，p50 變慢超過 threshold (比例) 即視為退步。
+def compare(results, baseline, threshold=0.2):
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is not None and current['p50'] > base['p50'] * (1 + threshold):
+            regressions.append((name, base['p50'], current['p50']))
+    return regressions
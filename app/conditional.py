@@ -0,0 +1,92 @@
+import hashlib
+import threading
+import time
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+
+class ConditionalGet:
+    # HTTP 條件式 GET: 以便宜的驗證值 (資料版本、最後修改時間) 加上網址、觀看者身分
+    # 與 FLASK_CONDITIONAL_MAX_AGE 的時間區間算出 ETag，與 If-None-Match 相符即回傳 304，
+    # 不渲染範本。時間區間讓含 CSRF token 的頁面在 token 過期前一定會重新渲染。
+    # 不送 Last-Modified 也不理會 If-Modified-Since: 單一時間無法表達觀看者與時間區間。
+    def __init__(self, *parts):
+        # 每頁的導覽列都有觀看者的名稱與頭像。
+        viewer = (current_user.get_id(), getattr(current_user, 'role_id', None),
+                  getattr(current_user, 'username', None), getattr(current_user, 'avatar_hash', None))
+        bucket = int(time.time() // current_app.config['FLASK_CONDITIONAL_MAX_AGE'])
+        key = repr((request.full_path, viewer, bucket, parts)).encode('utf-8')
+        self.etag = hashlib.sha1(key).hexdigest()
+
+    def eligible(self):
+        # 有待顯示的 flash 訊息時一定要渲染，否則訊息會留到下一頁。
+        return request.method == 'GET' and '_flashes' not in session
+
+    # 驗證值相符時回傳 304 回應，否則回傳 None 由呼叫端照常渲染。
+    def check(self):
+        if not self.eligible():
+            return None
+        stats = ConditionalStats.get()
+        if not request.if_none_match.contains_weak(self.etag):
+            stats.record(request.endpoint, self.etag, False)
+            return None
+        stats.record(request.endpoint, self.etag, True)
+        return self.headers(make_response('', 304))
+
+    def respond(self, body):
+        response = make_response(body)
+        if self.eligible() and response.status_code == 200:
+            ConditionalStats.get().store(self.etag, len(response.get_data()))
+            self.headers(response)
+        return response
+
+    def headers(self, response):
+        response.set_etag(self.etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+
+
+class ConditionalStats:
+    # 條件式 GET 的命中率，以及 304 省下的位元組數 (以同一 ETag 上次完整回應的大小估計)。
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sizes = {}
+        self.endpoints = {}
+
+    @staticmethod
+    def get():
+        app = current_app._get_current_object()
+        stats = app.extensions.get('conditional_stats')
+        if stats is None:
+            stats = app.extensions['conditional_stats'] = ConditionalStats()
+        return stats
+
+    def store(self, etag, size):
+        with self.lock:
+            if len(self.sizes) >= 4096:
+                self.sizes.clear()
+            self.sizes[etag] = size
+
+    def record(self, endpoint, etag, not_modified):
+        with self.lock:
+            entry = self.endpoints.setdefault(endpoint, {'requests': 0, 'not_modified': 0, 'bytes_saved': 0})
+            entry['requests'] += 1
+            if not_modified:
+                entry['not_modified'] += 1
+                entry['bytes_saved'] += self.sizes.get(etag, 0)
+
+    def stats(self):
+        with self.lock:
+            endpoints = {endpoint: dict(entry, hit_rate=entry['not_modified'] / entry['requests'])
+                         for endpoint, entry in self.endpoints.items()}
+        requests = sum(entry['requests'] for entry in endpoints.values())
+        not_modified = sum(entry['not_modified'] for entry in endpoints.values())
+        return {
+            'requests': requests,
+            'not_modified': not_modified,
+            'bytes_saved': sum(entry['bytes_saved'] for entry in endpoints.values()),
+            'hit_rate': not_modified / requests if requests else 0.0,
+            'endpoints': endpoints,
+        }
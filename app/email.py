@@ -1,20 +1,122 @@
-from threading import Thread
+import atexit
+import queue
+import threading
+import time
 from flask import current_app, render_template
-from flask_mail import Message
 from . import mail
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class EmailQueue:
+    # 固定數量的寄信執行緒。每個執行緒在佇列有信時沿用同一條 SMTP 連線，
+    # 閒置 FLASK_MAIL_IDLE_TIMEOUT 秒後才關閉。
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['FLASK_MAIL_QUEUE_SIZE'])
+        self.lock = threading.Lock()
+        self.sent = self.failed = self.dropped = 0
+        self.latency = self.max_latency = 0.0
+        self.closed = False
+        self.workers = [threading.Thread(target=self.run, daemon=True)
+                        for i in range(app.config['FLASK_MAIL_WORKERS'])]
+        for worker in self.workers:
+            worker.start()
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def get():
+        app = current_app._get_current_object()
+        email_queue = app.extensions.get('email_queue')
+        if email_queue is None:
+            email_queue = app.extensions['email_queue'] = EmailQueue(app)
+        return email_queue
+
+    # 佇列已滿時最多等待 FLASK_MAIL_QUEUE_TIMEOUT 秒，仍無空位則放棄這封信。
+    def put(self, msg):
+        try:
+            self.queue.put((time.monotonic(), msg), timeout=self.app.config['FLASK_MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            self.app.logger.error('Mail queue is full, dropped mail to %s.', msg.recipients)
+            return False
+        return True
+
+    def run(self):
+        with self.app.app_context():
+            conn = None
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.app.config['FLASK_MAIL_IDLE_TIMEOUT'] if conn else None)
+                except queue.Empty:
+                    conn = self.close(conn)
+                    continue
+                if item is None:
+                    self.close(conn)
+                    self.queue.task_done()
+                    return
+                conn = self.send(conn, *item)
+                self.queue.task_done()
+
+    # 寄送失敗時關閉連線，以指數退避重新連線重試。
+    def send(self, conn, queued, msg):
+        retries = self.app.config['FLASK_MAIL_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                if conn is None:
+                    conn = mail.connect()
+                    conn.__enter__()
+                conn.send(msg)
+            except Exception:
+                self.app.logger.exception('Failed to send mail to %s.', msg.recipients)
+                conn = self.close(conn)
+                if attempt < retries:
+                    time.sleep(self.app.config['FLASK_MAIL_RETRY_DELAY'] * 2 ** attempt)
+                continue
+            latency = time.monotonic() - queued
+            with self.lock:
+                self.sent += 1
+                self.latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            return conn
+        with self.lock:
+            self.failed += 1
+        return conn
+
+    @staticmethod
+    def close(conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self.queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'avg_latency': self.latency / self.sent if self.sent else 0.0,
+                'max_latency': self.max_latency,
+            }
+
+    # 送出佇列中剩餘的信後停止所有執行緒。
+    def shutdown(self, timeout=30):
+        if self.closed:
+            return
+        self.closed = True
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
 
 
 def send_email(to, subject, template, **kwargs):
+    from flask_mail import Message
     app = current_app._get_current_object()
     msg = Message(app.config['FLASK_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
                   sender=app.config['FLASK_MAIL_SENDER'], recipients=[to])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    return EmailQueue.get().put(msg)
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+from flask import current_app, render_template
+from jinja2 import Markup
+
+
+class FragmentCache:
+    # 已渲染的貼文區塊，以 post id 為鍵並附上 marker (留言數、內文、作者)，
+    # marker 不符即重新渲染，因此其他行程的修改也不會顯示舊內容。
+    # 依觀看者而異的部分 (Edit 標籤) 不在快取內: 區塊在 SPLIT 處切成前後兩段。
+    SPLIT = '<!-- viewer -->'
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def get():
+        app = current_app._get_current_object()
+        cache = app.extensions.get('fragment_cache')
+        if cache is None:
+            cache = app.extensions['fragment_cache'] = FragmentCache(app)
+        return cache
+
+    @staticmethod
+    def marker(post):
+        return (post.comment_count, hash(post.body_html),
+                post.author.username if post.author else None,
+                post.author.avatar_hash if post.author else None)
+
+    # 回傳 (前段, 後段)，呼叫端在兩段之間輸出依觀看者而異的內容。
+    def post(self, post):
+        marker = FragmentCache.marker(post)
+        with self.lock:
+            entry = self.entries.get(post.id)
+            if entry is not None and entry[0] == marker:
+                self.entries.move_to_end(post.id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        head, tail = render_template('_post.html', post=post).split(FragmentCache.SPLIT, 1)
+        parts = (Markup(head), Markup(tail))
+        with self.lock:
+            self.entries[post.id] = (marker, parts)
+            self.entries.move_to_end(post.id)
+            while len(self.entries) > self.app.config['FLASK_FRAGMENT_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+        return parts
+
+    def evict(self, post_id):
+        with self.lock:
+            if self.entries.pop(post_id, None) is not None:
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
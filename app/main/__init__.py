@@ -4,8 +4,14 @@ main = Blueprint('main', __name__)
 
 from . import views, errors
 from ..models import Permission, Status
+from ..fragments import FragmentCache
 
 
 @main.app_context_processor
 def inject_permissions():
-    return dict(Permission=Permission, Status=Status)
\ No newline at end of file
+    return dict(Permission=Permission, Status=Status)
+
+
+@main.app_context_processor
+def inject_fragments():
+    return dict(post_fragment=lambda post: FragmentCache.get().post(post))
\ No newline at end of file
@@ -56,14 +56,16 @@ class AskLeaveForm(FlaskForm):
 
     def __init__(self, user, *args, **kwargs):
         super(AskLeaveForm, self).__init__(*args, **kwargs)
-        self.leave_type.choices = [(t.id, t.name)
-                                    for t in LeaveType.query.order_by(LeaveType.id).all()
-                                    if t.has_permission(user.gender)]
-        self.agents.choices = [(u.id, u.username)
-                                for u in User.query.filter_by(department_id=user.department_id).all()
-                                if u.id != user.id]
+        self.leave_type.choices = list(LeaveType.choices(user.gender))
+        self.agents.choices = [(id, username)
+                                for id, username in Department.agent_choices(user.department_id)
+                                if id != user.id]
         self.user = user
 
+class ReviewLeaveForm(FlaskForm):
+    agree = SubmitField('同意')
+    turn_down = SubmitField('駁回')
+
 class WorkHolidayForm(FlaskForm):
     workday = SelectField('事件', coerce=int, choices=[(0, '放假'), (1, '上班')])
     startDate = DateField('起始日期:', default=datetime.today(), validators=[DataRequired()])
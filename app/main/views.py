@@ -1,17 +1,25 @@
 from datetime import datetime
-from flask import render_template, redirect, url_for, abort, flash, request, current_app, make_response
+from flask import render_template, redirect, url_for, abort, flash, request, current_app, make_response, jsonify
 from flask_login import login_required, current_user
+from flask_sqlalchemy import Pagination
 from . import main
-from .forms import EditProfileForm, EditProfileAdminForm, AskLeaveForm, WorkHolidayForm, PostForm, CommentForm
+from .forms import EditProfileForm, EditProfileAdminForm, AskLeaveForm, ReviewLeaveForm, WorkHolidayForm, PostForm, CommentForm
 from .. import db
-from ..models import Permission, User, Role, LeaveLog, Time, Status, WorkOrHoliday, Post, Comment
-from ..email import send_email
+from ..models import Permission, User, Role, LeaveLog, Status, WorkOrHoliday, Post, Comment
 from ..decorators import admin_required, permission_required
+from ..pagination import paginate
+from ..fragments import FragmentCache
+from ..conditional import ConditionalGet, ConditionalStats
+from ..email import EmailQueue
 
 @main.route('/bad')
 def bad():
     abort(500)
 
+# 頁面上顯示的作者欄位。
+def author_parts(user):
+    return (user.username, user.avatar_hash) if user is not None else None
+
 @main.route('/', methods=['GET', 'POST'])
 @login_required
 def index():
@@ -22,30 +30,39 @@ def index():
         db.session.add(post)
         db.session.commit()
         return redirect(url_for('.index'))
-    page = request.args.get('page', 1, type=int)
-    query = Post.query
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASK_POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(Post.query.options(db.selectinload(Post.author)),
+                          [(Post.timestamp, True), (Post.id, True)],
+                          current_app.config['FLASK_POSTS_PER_PAGE'])
     posts = pagination.items
-    return render_template('index.html', form=form, posts=posts, pagination=pagination)
+    # 驗證值取自本頁顯示的內容 (含作者名稱與頭像)，只省下範本渲染。
+    conditional = ConditionalGet([(p.id, p.updated, p.comment_count, author_parts(p.author)) for p in posts],
+                                 pagination.has_prev, pagination.has_next, pagination.total)
+    response = conditional.check()
+    if response is not None:
+        return response
+    return conditional.respond(render_template('index.html', form=form, posts=posts, pagination=pagination))
 
 @main.route('/user/<username>')
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    return render_template('user.html', user=user)
+    # 只取頁面上顯示的欄位。
+    conditional = ConditionalGet(user.username, user.email, user.avatar_hash, user.name, user.location, user.about_me,
+                                 user.department.name if user.department else None,
+                                 user.off_leave_start, user.off_leave_end, user.officalLeave,
+                                 user.member_since, user.last_seen)
+    response = conditional.check()
+    if response is not None:
+        return response
+    return conditional.respond(render_template('user.html', user=user))
 
 @main.route('/user/list')
 @login_required
 def user_list():
-    page = request.args.get('page', 1, type=int)
-    query=User.query
-    pagination = query.order_by(User.id).paginate(
-                page, per_page=current_app.config['FLASK_USER_PER_PAGE'],
-                error_out=False)
+    pagination = paginate(User.query.options(db.selectinload(User.department).load_only('name')),
+                          [(User.id, False)], current_app.config['FLASK_USER_PER_PAGE'])
     users = pagination.items
-    return render_template('user_list.html', users=users)
+    return render_template('user_list.html', users=users, pagination=pagination)
 
 @main.route('/edit-profile', methods=['GET', 'POST'])
 @login_required
@@ -91,7 +108,7 @@ def edit_profile_admin(id):
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
 def post(id):
-    post = Post.query.get_or_404(id)
+    post = Post.query.options(db.joinedload(Post.author)).get_or_404(id)
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data,
@@ -102,14 +119,20 @@ def post(id):
         flash('您的評論已發布。')
         return redirect(url_for('.post', id=post.id, page=-1))
     page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['FLASK_COMMENTS_PER_PAGE']
     if page == -1:
-        page = (post.comments.count() - 1) // \
-            current_app.config['FLASK_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config['FLASK_COMMENTS_PER_PAGE'],
-        error_out=False)
-    comments = pagination.items
-    return render_template('post.html', posts=[post], form=form, comments=comments, pagination=pagination)
+        page = (post.comment_count - 1) // per_page + 1
+    page = max(page, 1)
+    comments = post.comments.options(db.selectinload(Comment.author)) \
+        .order_by(Comment.timestamp.asc()).offset((page - 1) * per_page).limit(per_page).all()
+    conditional = ConditionalGet(page, post.updated, post.comment_count, author_parts(post.author),
+                                 [(c.id, c.disabled, author_parts(c.author)) for c in comments])
+    response = conditional.check()
+    if response is not None:
+        return response
+    pagination = Pagination(None, page, per_page, post.comment_count, comments)
+    return conditional.respond(render_template('post.html', posts=[post], form=form, comments=comments,
+                                               pagination=pagination))
 
 @main.route('/edit/<int:id>', methods=['GET', 'POST'])
 @login_required
@@ -135,22 +158,20 @@ def askLeave():
     if current_user.can(Permission.ASK_LEAVE) and form.validate_on_submit():
         start = datetime.strptime("{} {}".format(form.startDate.data, form.startTime.data), "%Y-%m-%d %H:%M:%S")
         end=datetime.strptime("{} {}".format(form.endDate.data, form.endTime.data), "%Y-%m-%d %H:%M:%S")
-        for i in LeaveLog.query.filter_by(staff_id=current_user.id):
-            if Time.dateOverlap(start, end, i.start, i.end):
-                flash('你的休假日期有重疊。')
-                return redirect(url_for('.askLeave'))
+        if LeaveLog.has_overlap(current_user.id, start, end):
+            flash('你的休假日期有重疊。')
+            conflicts = LeaveLog.overlapping(current_user.id, start, end).order_by(LeaveLog.start).all()
+            return render_template('askLeave.html', form=form, conflicts=conflicts)
         log = LeaveLog( start=start, end=end, reason=form.reason.data, 
                         department_id=current_user.department_id, type_id=form.leave_type.data, 
                         staff_id=current_user.id, agent_id=form.agents.data)
         db.session.add(log)
         db.session.commit()
-        reviewer = current_user.department.supervisor() \
-            if not current_user.can(Permission.REVIEW_LEAVE) and current_user.department.supervisor() \
-                else User.query.filter_by(email=current_app.config['FLASK_ADMIN']).first_or_404()
-        agree_token = reviewer.generate_review_leave_token(log, Status.AGREE)
-        turn_down_token = reviewer.generate_review_leave_token(log, Status.TURN_DOWN)
-        send_email(reviewer.email, '請假申請函',
-                   'email/askLeave', user=reviewer, applicant=current_user, leaveLog=log, agree_token=agree_token, turn_down_token=turn_down_token)
+        reviewer = current_user.reviewer()
+        if reviewer is None:
+            abort(404)
+        log.notify_reviewer(reviewer)
+        db.session.commit()
         flash('請假申請已在審核中。')
         return redirect(url_for('.askLeave'))
     return render_template('askLeave.html', form=form)
@@ -163,10 +184,24 @@ def reviewLeave(token):
         flash('你已經更新了假期日誌。 謝謝！')
     return redirect(url_for('main.index'))
 
+@main.route('/pendingLeave', methods=['GET', 'POST'])
+@login_required
+@permission_required(Permission.REVIEW_LEAVE)
+def pendingLeave():
+    form = ReviewLeaveForm()
+    if form.validate_on_submit():
+        status = Status.AGREE if form.agree.data else Status.TURN_DOWN
+        count = LeaveLog.review_many(current_user, request.form.getlist('ids', type=int), status)
+        db.session.commit()
+        flash('已更新 {} 筆請假。'.format(count))
+        return redirect(url_for('.pendingLeave'))
+    leaveLogs = LeaveLog.review_queue(current_user).options(db.selectinload(LeaveLog.staff)) \
+        .order_by(LeaveLog.timestamp).all()
+    return render_template('pendingLeave.html', form=form, leaveLogs=leaveLogs)
+
 @main.route('/leaveLog', methods=['GET', 'POST'])
 @login_required
 def leaveLog():
-    page = request.args.get('page', 1, type=int)
     log_status = request.cookies.get('log_status', '')
     if log_status == '0':
         query = LeaveLog.query
@@ -176,11 +211,22 @@ def leaveLog():
         query = current_user.department.leaveLogs
     else:
         query = current_user.ask_leave
-    pagination = query.order_by(LeaveLog.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASK_LEAVE_LOG_PER_PAGE'],
-        error_out=False)
+    query = query.options(db.joinedload(LeaveLog.type).load_only('name'))
+    if log_status != '1':
+        query = query.options(db.selectinload(LeaveLog.staff).load_only('username'))
+    pagination = paginate(query, [(LeaveLog.timestamp, True), (LeaveLog.id, True)],
+                          current_app.config['FLASK_LEAVE_LOG_PER_PAGE'])
     leaveLogs = pagination.items
-    return render_template('leaveLog.html', leaveLogs=leaveLogs, log_status=log_status, pagination=pagination)
+    # 驗證值取自本頁顯示的內容 (含申請者名稱與假別名稱)，只省下範本渲染。
+    conditional = ConditionalGet(log_status, [(l.id, l.updated, l.type.name if l.type else None,
+                                               l.staff.username if log_status != '1' and l.staff else None)
+                                              for l in leaveLogs],
+                                 pagination.has_prev, pagination.has_next, pagination.total)
+    response = conditional.check()
+    if response is not None:
+        return response
+    return conditional.respond(render_template('leaveLog.html', leaveLogs=leaveLogs, log_status=log_status,
+                                               pagination=pagination))
 
 @main.route('/allLog')
 @login_required
@@ -221,14 +267,14 @@ def work_or_holiday():
     if form.validate_on_submit():
         start = datetime.strptime("{} 00:00:00".format(form.startDate.data), "%Y-%m-%d %H:%M:%S")
         end=datetime.strptime("{} 23:59:59".format(form.endDate.data), "%Y-%m-%d %H:%M:%S")
-        today = datetime.strptime(datetime.today().strftime('%Y-%m-%d'), '%Y-%m-%d')
-        for i in WorkOrHoliday.query.filter(WorkOrHoliday.end>=today):
-            if Time.dateOverlap(start, end, i.start, i.end):
-                flash('紀錄重疊')
-                return redirect(url_for('.work_or_holiday'))
+        if WorkOrHoliday.find_overlapping(start, end).first():
+            flash('紀錄重疊')
+            return redirect(url_for('.work_or_holiday'))
         print(form.workday.data)
         log = WorkOrHoliday(start=start, end=end, reason=form.reason.data, workday=int(form.workday.data))
         db.session.add(log)
+        db.session.flush()
+        LeaveLog.recompute_range(start, end)
         db.session.commit()
         flash('已新增事件')
         return redirect(url_for('.work_or_holiday'))
@@ -263,12 +309,11 @@ def show_work_or_holiday_form():
 @login_required
 @permission_required(Permission.MODERATE)
 def moderate():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASK_COMMENTS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(Comment.query.options(db.selectinload(Comment.author)),
+                          [(Comment.timestamp, True), (Comment.id, True)],
+                          current_app.config['FLASK_COMMENTS_PER_PAGE'])
     comments = pagination.items
-    return render_template('moderate.html', comments=comments, pagination=pagination, page=page)
+    return render_template('moderate.html', comments=comments, pagination=pagination)
 
 
 @main.route('/moderate/enable/<int:id>')
@@ -279,7 +324,7 @@ def moderate_enable(id):
     comment.disabled = False
     db.session.add(comment)
     db.session.commit()
-    return redirect(url_for('.moderate', page=request.args.get('page', 1, type=int)))
+    return redirect(url_for('.moderate', cursor=request.args.get('cursor')))
 
 
 @main.route('/moderate/disable/<int:id>')
@@ -290,4 +335,12 @@ def moderate_disable(id):
     comment.disabled = True
     db.session.add(comment)
     db.session.commit()
-    return redirect(url_for('.moderate', page=request.args.get('page', 1, type=int)))
+    return redirect(url_for('.moderate', cursor=request.args.get('cursor')))
+
+
+@main.route('/cache-stats')
+@login_required
+@admin_required
+def cache_stats():
+    return jsonify(fragments=FragmentCache.get().stats(), conditional=ConditionalStats.get().stats(),
+                   mail=EmailQueue.get().stats())
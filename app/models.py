@@ -1,13 +1,25 @@
 from datetime import datetime, timedelta
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import calendar
+import atexit
+import functools
 import hashlib
+import itertools
+import math
+import threading
+import time
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from markdown import markdown
-import bleach
-from flask import current_app, flash
+from flask import current_app, flash, g, has_request_context
 from flask_login import UserMixin
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from . import db, login_manager
+from .email import send_email
+from .fragments import FragmentCache
 
 class Permission:
     COMMENT = 1
@@ -27,6 +39,13 @@ class Status:
     TURN_DOWN = 2
     AGREE = 4
 
+class LedgerType:
+    OPENING = 1
+    ACCRUAL = 2
+    APPROVAL = 3
+    REVERSAL = 4
+    ADJUSTMENT = 5
+
 class WorkOrHoliday(db.Model):
     __tablename__ = 'work_or_holiday'
     id = db.Column(db.Integer, primary_key=True)
@@ -34,15 +53,167 @@ class WorkOrHoliday(db.Model):
     end = db.Column(db.DateTime)
     reason = db.Column(db.Text)
     workday = db.Column(db.Integer)
+    __table_args__ = (db.Index('ix_work_or_holiday_start_end', 'start', 'end'),)
+
+    # 與 start ~ end 重疊的事件。涵蓋 start 的事件最早在 start 減去最長事件長度時開始，
+    # 只需從那裡開始找，查詢範圍不隨資料量成長；舊資料中彼此重疊的事件也找得到。
+    @staticmethod
+    def find_overlapping(start, end):
+        return WorkOrHoliday.query.filter(WorkOrHoliday.start >= start - WorkOrHoliday.longest(),
+                                          WorkOrHoliday.start <= end, WorkOrHoliday.end >= start)
+
+    # 最長事件的長度的上限，存在 work_calendar_stamp 中，新增或修改事件時在同一個 flush 中調大，
+    # 刪除或縮短事件時不調小 (上限偏大只會讓查詢範圍略寬，結果仍正確)。
+    @staticmethod
+    def longest():
+        return timedelta(seconds=WorkCalendar.stamp()[1])
+
+    # 重新計算最長事件長度，供既有資料庫建立 work_calendar_stamp 後執行一次。
+    @staticmethod
+    def rebuild_longest():
+        spans = db.session.query(WorkOrHoliday.start, WorkOrHoliday.end) \
+            .filter(WorkOrHoliday.start.isnot(None), WorkOrHoliday.end.isnot(None))
+        longest = max([timedelta(0)] + [e - s for s, e in spans])
+        stamp = WorkCalendarStamp.__table__
+        db.session.execute(stamp.update().where(stamp.c.id == 1).values(longest=math.ceil(longest.total_seconds())))
+        WorkOrHoliday.on_changed(None, db.session, None)
+
+    @staticmethod
+    def covering(date):
+        return WorkOrHoliday.find_overlapping(date, date).order_by(WorkOrHoliday.id).first()
 
     @staticmethod
     def not_workday(date):
-        log = WorkOrHoliday.query.filter(WorkOrHoliday.start <= date, WorkOrHoliday.end >= date).first()
-        if log:
-            return (not log.workday) or (date.weekday() >= 5 and not log.workday)
-        else:
-            return date.weekday() >= 5
-        
+        return not WorkCalendar.is_workday(date)
+
+    # 以 Core 批次寫入事件時不會觸發 mapper 事件，需自行以
+    # on_changed(None, db.session, None, longest=最長的新事件長度) 通知。
+    @staticmethod
+    def on_changed(mapper, connection, target, longest=None):
+        if target is not None and target.start is not None and target.end is not None:
+            longest = target.end - target.start
+        WorkCalendar.changed(connection, longest)
+
+db.event.listen(WorkOrHoliday, 'after_insert', WorkOrHoliday.on_changed)
+db.event.listen(WorkOrHoliday, 'after_update', WorkOrHoliday.on_changed)
+db.event.listen(WorkOrHoliday, 'after_delete', WorkOrHoliday.on_changed)
+
+class WorkCalendarStamp(db.Model):
+    # work_or_holiday 的版本戳記，只有 id = 1 一筆。每次異動事件都在同一個 flush 中遞增 version，
+    # longest 為最長事件長度 (秒) 的上限。
+    __tablename__ = 'work_calendar_stamp'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    longest = db.Column(db.Integer, nullable=False, default=0)
+
+db.event.listen(WorkCalendarStamp.__table__, 'after_create',
+                lambda table, connection, **kw: connection.execute(table.insert().values(id=1, version=0, longest=0)))
+
+class WorkCalendar:
+    # 工作日索引: 每年一張位元圖，第 n 個位元代表該年第 n 天是否上班。
+    # 位元圖存在各行程內，每個 app context 先比對一次 work_calendar_stamp 的版本，
+    # 版本不同 (其他 worker 異動過事件) 才重新查詢 work_or_holiday。
+    @staticmethod
+    def _cache():
+        return current_app.extensions.setdefault('work_calendar', {})
+
+    @staticmethod
+    def invalidate():
+        WorkCalendar._cache().clear()
+
+    # (version, longest)，每個 app context 只查詢一次。
+    @staticmethod
+    def stamp():
+        if 'work_calendar_stamp' not in g:
+            row = db.session.query(WorkCalendarStamp.version, WorkCalendarStamp.longest).filter_by(id=1).first()
+            g.work_calendar_stamp = tuple(row) if row is not None else (0, 0)
+        return g.work_calendar_stamp
+
+    # 遞增版本、必要時調大 longest，並清除本行程的位元圖。
+    @staticmethod
+    def changed(connection, longest=None):
+        stamp = WorkCalendarStamp.__table__
+        seconds = math.ceil(longest.total_seconds()) if longest is not None else 0
+        values = {'version': stamp.c.version + 1,
+                  'longest': db.case([(stamp.c.longest < seconds, seconds)], else_=stamp.c.longest)}
+        if not connection.execute(stamp.update().where(stamp.c.id == 1).values(**values)).rowcount:
+            connection.execute(stamp.insert().values(id=1, version=1, longest=seconds))
+        g.pop('work_calendar_stamp', None)
+        WorkCalendar.invalidate()
+
+    @staticmethod
+    def build(year):
+        first = datetime(year, 1, 1)
+        days = 366 if calendar.isleap(year) else 365
+        bits = bytearray((days + 7) // 8)
+        for i in range(days):
+            if (first + timedelta(days=i)).weekday() < 5:
+                bits[i >> 3] |= 1 << (i & 7)
+        # 與 query.first() 相同，重疊時以 id 較小的事件為準。
+        logs = WorkOrHoliday.find_overlapping(first, datetime(year, 12, 31, 23, 59, 59)) \
+                            .order_by(WorkOrHoliday.id.desc()).all()
+        for log in logs:
+            s = datetime(log.start.year, log.start.month, log.start.day)
+            if s < log.start:
+                s += timedelta(days=1)
+            s = max((s - first).days, 0)
+            e = min((log.end - first).days, days - 1)
+            for i in range(s, e + 1):
+                if log.workday:
+                    bits[i >> 3] |= 1 << (i & 7)
+                else:
+                    bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+        return bytes(bits)
+
+    @staticmethod
+    def year(year):
+        cache = WorkCalendar._cache()
+        version = WorkCalendar.stamp()[0]
+        if current_app.extensions.get('work_calendar_version') != version:
+            cache.clear()
+            current_app.extensions['work_calendar_version'] = version
+        bits = cache.get(year)
+        if bits is None:
+            bits = cache[year] = WorkCalendar.build(year)
+        return bits
+
+    @staticmethod
+    def is_workday(date):
+        return WorkCalendar.test({date.year: WorkCalendar.year(date.year)}, date)
+
+    # 取出 first ~ last 年的位元圖，可傳給其他行程使用。
+    @staticmethod
+    def snapshot(first, last):
+        return {y: WorkCalendar.year(y) for y in range(first, last + 1)}
+
+    @staticmethod
+    def test(years, date):
+        bits = years[date.year]
+        i = date.timetuple().tm_yday - 1
+        return bool(bits[i >> 3] >> (i & 7) & 1)
+
+    # 累計工作日數: prefix(bits)[i] 為該年前 i 天的工作日數。
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def prefix(bits):
+        counts = array('H', [0])
+        n = 0
+        for i in range(len(bits) * 8):
+            n += bits[i >> 3] >> (i & 7) & 1
+            counts.append(n)
+        return counts
+
+    # [start, end) 之間的工作日數。
+    @staticmethod
+    def count(years, start, end):
+        total = 0
+        for y in range(start.year, end.year + 1):
+            counts = WorkCalendar.prefix(years[y])
+            s = start.timetuple().tm_yday - 1 if y == start.year else 0
+            e = end.timetuple().tm_yday - 1 if y == end.year else len(counts) - 1
+            total += counts[e] - counts[s]
+        return total
+
 class Time():
     # 日期間格。
     @staticmethod
@@ -82,73 +253,125 @@ class Time():
 
     # 當日工時。
     @staticmethod
-    def workingHours_day(start, end):
-        fmt = '%H:%M:%S'
-        st = datetime.strptime(start, fmt)
-        et = datetime.strptime(end, fmt)
-        noon = datetime.strptime('12:00:00', fmt)
-        afterNoon = datetime.strptime('13:00:00', fmt)
-        evening = datetime.strptime('18:00:00', fmt)
-        if(st >= et or st > evening):
-            raise AttributeError('Wrong time range.')
-        elif(st < datetime.strptime('09:00:00', fmt)):
-            st = datetime.strptime('09:00:00', fmt)
-        if(st < noon):
-            if(et < noon):
-                return (et-st).seconds
-            elif(et <= afterNoon):
-                return (noon-st).seconds
-            elif(et < evening):
-                return (noon-st).seconds + (et-afterNoon).seconds
-            else:
-                return (noon-st).seconds + (evening-afterNoon).seconds
-        else:
-            if(st > afterNoon):
-                if(et < evening):
-                    return (et-st).seconds
-                else:
-                    return (evening-st).seconds
-            else:
-                if(et < evening):
-                    return (et-afterNoon).seconds
-                else:
-                    return (evening-afterNoon).seconds
+    def workingHours_day(start, end, schedule=None):
+        return (schedule or WorkSchedule.DEFAULT).seconds(WorkSchedule.clock(start), WorkSchedule.clock(end))
     
     # 期間工時。
     @staticmethod
-    def workingHours_days(start, end):
-        seconds = 0
+    def workingHours_days(start, end, schedule=None):
         if(start >= end):
             raise AttributeError('Dates are in wrong order.')
-        sd = date = datetime.strptime(start.strftime('%Y-%m-%d'), '%Y-%m-%d')
-        ed = datetime.strptime(end.strftime('%Y-%m-%d'), '%Y-%m-%d')
-        while(date <= ed):
-            # if(date.weekday() >= 5):
-            if(WorkOrHoliday.not_workday(date)):
-                date += timedelta(days=1)
-                continue
-            if(date == sd):
-                if(sd == ed):
-                    seconds += Time.workingHours_day(start.strftime('%H:%M:%S'), end.strftime('%H:%M:%S'))
-                else:
-                    seconds += Time.workingHours_day(start.strftime('%H:%M:%S'), '18:00:00')
-            elif(date == ed):
-                seconds += Time.workingHours_day('09:00:00', end.strftime('%H:%M:%S'))
-            else:
-                seconds += 8*60*60
-            date += timedelta(days=1)
+        return Time.workingHours_batch([(start, end, schedule)])[0]
+
+    # 批次計算多筆期間工時，spans 為 (start, end) 或 (start, end, schedule)，
+    # years 為 WorkCalendar.snapshot() 的結果。
+    @staticmethod
+    def workingHours_batch(spans, years=None):
+        if not spans:
+            return []
+        if years is None:
+            years = WorkCalendar.snapshot(min(s[0].year for s in spans), max(s[1].year for s in spans))
+        return [Time.workingHours_span(years, *span) for span in spans]
+
+    @staticmethod
+    def workingHours_span(years, start, end, schedule=None):
+        if(start >= end):
+            raise AttributeError('Dates are in wrong order.')
+        schedule = schedule or WorkSchedule.DEFAULT
+        st = start.hour*3600 + start.minute*60 + start.second
+        et = end.hour*3600 + end.minute*60 + end.second
+        sd = datetime(start.year, start.month, start.day)
+        ed = datetime(end.year, end.month, end.day)
+        if(sd == ed):
+            if(not WorkCalendar.test(years, sd)):
+                return 0
+            return schedule.seconds(st, et)
+        seconds = WorkCalendar.count(years, sd + timedelta(days=1), ed) * schedule.total
+        if(WorkCalendar.test(years, sd)):
+            seconds += schedule.seconds(st, schedule.end)
+        if(WorkCalendar.test(years, ed)):
+            seconds += schedule.seconds(schedule.start, et)
         return seconds
 
+class WorkSchedule:
+    # 班表: 各時段以午夜起算的分鐘數表示，內部換算成秒數以整數運算計算工時。
+    # 時段須落在同一天內 (結束可為 24:00) 且互不重疊；跨夜班以當天的兩段表示，
+    # 例如 22:00 ~ 隔天 06:00 寫成 '00:00-06:00,22:00-24:00'。
+    def __init__(self, segments=((9*60, 12*60), (13*60, 18*60))):
+        self.segments = tuple(sorted((s*60, e*60) for s, e in segments))
+        if not self.segments:
+            raise ValueError('Empty work schedule.')
+        for s, e in self.segments:
+            if not 0 <= s < e <= 24*3600:
+                raise ValueError('Wrong work schedule segment {}-{}.'.format(s // 60, e // 60))
+        for (s1, e1), (s2, e2) in zip(self.segments, self.segments[1:]):
+            if s2 < e1:
+                raise ValueError('Overlapping work schedule segments.')
+        self.start = self.segments[0][0]
+        self.end = self.segments[-1][1]
+        self.total = sum(e - s for s, e in self.segments)
+
+    # 'HH:MM:SS' 轉為午夜起算的秒數。
+    @staticmethod
+    def clock(text):
+        h, m, s = text.split(':')
+        return int(h)*3600 + int(m)*60 + int(s)
+
+    # 由 '09:00-12:00,13:00-18:00' 格式建立班表，格式或時段不正確時拋出 ValueError。
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def parse(text):
+        segments = []
+        for segment in text.split(','):
+            s, e = segment.strip().split('-')
+            segments.append(tuple(WorkSchedule.clock(t.strip() + ':00') // 60 for t in (s, e)))
+        return WorkSchedule(segments)
+
+    # 部門 id -> 班表的快取。異動事件只會清除本行程的快取，因此另以
+    # FLASK_LOOKUP_CACHE_TTL 限制其他行程看到舊班表的時間。
+    @staticmethod
+    def for_department(department_id):
+        entry = current_app.extensions.get('work_schedule')
+        if entry is None or entry[0] < time.monotonic():
+            cache = {}
+            for d in db.session.query(Department.id, Department.schedule).filter(Department.schedule.isnot(None)):
+                try:
+                    cache[d.id] = WorkSchedule.parse(d.schedule)
+                except ValueError:
+                    current_app.logger.error('Department %s has an invalid schedule %r, using the default.',
+                                             d.id, d.schedule)
+            entry = current_app.extensions['work_schedule'] = \
+                (time.monotonic() + current_app.config['FLASK_LOOKUP_CACHE_TTL'], cache)
+        return entry[1].get(department_id, WorkSchedule.DEFAULT)
+
+    @staticmethod
+    def invalidate(mapper=None, connection=None, target=None):
+        current_app.extensions.pop('work_schedule', None)
+
+    # 某時段 [st, et) 與班表重疊的秒數。
+    def seconds(self, st, et):
+        if(st >= et or st > self.end):
+            raise AttributeError('Wrong time range.')
+        total = 0
+        for s, e in self.segments:
+            if(st < e and et > s):
+                total += min(et, e) - max(st, s)
+        return total
+
+WorkSchedule.DEFAULT = WorkSchedule()
+
 class OfficalLeave:
+    SENIORITY_LEAVE = [ False, 7, 10, 14, 14, # 0~4年
+                        15, 15, 15, 15, 15, # 5~9年
+                        16, 17, 18, 19, 20, # 10~14年
+                        21, 22, 23, 24, 25, # 15~19年
+                        26, 27, 28, 29, 30 ] # 20~24年以上
+
     # 計算年資，並轉為特休天數。
     @staticmethod
     def seniorityToLeave(start, end):
         seniority = Time.dateInterval(start, end)
-        buf = [ False, 7, 10, 14, 14, # 0~4年
-                15, 15, 15, 15, 15, # 5~9年
-                16, 17, 18, 19, 20, # 10~14年
-                21, 22, 23, 24, 25, # 15~19年
-                26, 27, 28, 29, 30 ] # 20~24年以上
+        buf = OfficalLeave.SENIORITY_LEAVE
         if(seniority[0] >= 1):
             return buf[seniority[0]] if seniority[0] <= 24 else buf[-1]
         else:
@@ -177,14 +400,18 @@ class OfficalLeave:
         if firstDay.month > 6:
             return [False, False]
         else:
-            return [datetime.strptime('{}-{}-{}'.format(firstDay.year, firstDay.month+6, firstDay.day), '%Y-%m-%d'),
-                    datetime.strptime('{}-12-31'.format(firstDay.year), '%Y-%m-%d')]
+            return [datetime(firstDay.year, firstDay.month+6, firstDay.day), datetime(firstDay.year, 12, 31)]
 
-    # 以到職日計算某年特休天數 (新年限定)
+    # 以到職日計算某年特休天數 (新年限定)。同到職日、同年度的結果會被快取。
     @staticmethod
     def newYear(firstDay, thatYear):
+        return list(OfficalLeave._newYear(firstDay, thatYear))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _newYear(firstDay, thatYear):
         result = 0
-        firstYear = datetime.strptime('{}-01-01'.format(thatYear), '%Y-%m-%d')
+        firstYear = datetime(thatYear, 1, 1)
         if(firstDay >= firstYear):
             raise AttributeError('first day is wrong.')
         nextYear = thatYear + 1
@@ -196,26 +423,38 @@ class OfficalLeave:
         # 今年開始的年資的上半部分
         offLeave = OfficalLeave.seniorityToLeave(firstDay, firstYear) \
             if(firstDay.month == 1 and firstDay.day == 1) \
-                else OfficalLeave.seniorityToLeave(firstDay, datetime.strptime('{}-01-01'.format(nextYear), '%Y-%m-%d'))
+                else OfficalLeave.seniorityToLeave(firstDay, datetime(nextYear, 1, 1))
         seniorityRange = 6 if offLeave <= 3 else 12
         thisOffLeave = offLeave - (OfficalLeave.yearProportion(firstDay, seniorityRange) * offLeave)
         result += thisOffLeave
         result = round(round(round(result, 3), 2), 1)
-        return [datetime.strptime('{}-01-01'.format(thatYear), '%Y-%m-%d'),
-                datetime.strptime('{}-12-31'.format(thatYear), '%Y-%m-%d'),
-                result]
+        return (datetime(thatYear, 1, 1), datetime(thatYear, 12, 31), result)
 
     # 以到職日計算當年計算特休天數 (新員工限定)
     @staticmethod
     def newStaff(firstDay):
+        return list(OfficalLeave._newStaff(firstDay))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _newStaff(firstDay):
         result = OfficalLeave.firstDateOfUse(firstDay)
-        thisYear = datetime.strptime('{}-12-31'.format(firstDay.year), '%Y-%m-%d')
+        thisYear = datetime(firstDay.year, 12, 31)
         # 今年開始的年資的上半部分
         offLeave = OfficalLeave.seniorityToLeave(firstDay, thisYear)
         seniorityRange = 6 if offLeave <= 3 else 12
         buf = offLeave - (OfficalLeave.yearProportion(firstDay, seniorityRange) * offLeave)
         result.append(round(round(round(buf, 3), 2), 1))
-        return result
+        return tuple(result)
+
+    # 快取命中統計。
+    @staticmethod
+    def cache_info():
+        info = {}
+        for name, f in (('newYear', OfficalLeave._newYear), ('newStaff', OfficalLeave._newStaff)):
+            i = f.cache_info()
+            info[name] = {'hits': i.hits, 'misses': i.misses, 'size': i.currsize, 'maxsize': i.maxsize}
+        return info
 
 class LeaveType(db.Model):
     __tablename__ = 'leave_types'
@@ -261,28 +500,203 @@ class LeaveType(db.Model):
     def has_permission(self, perm):
         return self.permissions & perm == perm
 
+    # AskLeaveForm 的假別選項 (id, name)，依性別快取 FLASK_LOOKUP_CACHE_TTL 秒，只查詢需要的欄位。
+    @staticmethod
+    def choices(gender):
+        cache = current_app.extensions.setdefault('leave_type_choices', {})
+        entry = cache.get(gender)
+        if entry is None or entry[0] < time.monotonic():
+            rows = db.session.query(LeaveType.id, LeaveType.name, LeaveType.permissions).order_by(LeaveType.id)
+            entry = cache[gender] = (time.monotonic() + current_app.config['FLASK_LOOKUP_CACHE_TTL'],
+                                     tuple((id, name) for id, name, permissions in rows
+                                           if permissions & gender == gender))
+        return entry[1]
+
+    @staticmethod
+    def invalidate_choices(mapper=None, connection=None, target=None):
+        current_app.extensions.pop('leave_type_choices', None)
+
     def __repr__(self):
         return '<LeaveType %r>' % self.name
 
+db.event.listen(LeaveType, 'after_insert', LeaveType.invalidate_choices)
+db.event.listen(LeaveType, 'after_update', LeaveType.invalidate_choices)
+db.event.listen(LeaveType, 'after_delete', LeaveType.invalidate_choices)
+
 class LeaveLog(db.Model):
     __tablename__ = 'leave_logs'
     id = db.Column(db.Integer, primary_key=True)
-    start = db.Column(db.DateTime)
-    end = db.Column(db.DateTime)
+    start = db.Column(db.DateTime, index=True)
+    end = db.Column(db.DateTime, index=True)
     duration = db.Column(db.Float)
     reason = db.Column(db.Text)
     status = db.Column(db.Integer)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    updated = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
     department_id = db.Column(db.Integer, db.ForeignKey('departments.id'))
     type_id = db.Column(db.Integer, db.ForeignKey('leave_types.id'))
     staff_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     agent_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    reviewer_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    notified = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_leave_logs_staff_id_start_end', 'staff_id', 'start', 'end'),
+                      db.Index('ix_leave_logs_reviewer_id_notified', 'reviewer_id', 'notified'))
 
     def __init__(self, **kwargs):
         super(LeaveLog, self).__init__(**kwargs)
         if self.status is None:
             self.status = Status.UNDER_REVIEW
-        self.duration=round(Time.workingHours_days(self.start, self.end)/3600, 2)
+        self.duration=round(Time.workingHours_days(self.start, self.end,
+                                                   WorkSchedule.for_department(self.department_id))/3600, 2)
+
+    # 與 start ~ end 重疊且未被駁回的請假。
+    @staticmethod
+    def overlapping(staff_id, start, end):
+        return LeaveLog.query.filter(LeaveLog.staff_id == staff_id,
+                                     LeaveLog.start <= end, LeaveLog.end >= start,
+                                     LeaveLog.status != Status.TURN_DOWN)
+
+    @staticmethod
+    def has_overlap(staff_id, start, end):
+        return db.session.query(LeaveLog.overlapping(staff_id, start, end).exists()).scalar()
+
+    # 假日異動後，只重新計算與 start ~ end 重疊的請假，並補正已核准特休的餘額。
+    @staticmethod
+    def recompute_range(start, end):
+        logs = LeaveLog.query.options(db.joinedload(LeaveLog.type)) \
+            .filter(LeaveLog.start <= end, LeaveLog.end >= start).all()
+        changed = 0
+        spans = [(l.start, l.end, WorkSchedule.for_department(l.department_id)) for l in logs]
+        for log, seconds in zip(logs, Time.workingHours_batch(spans)):
+            duration = round(seconds/3600, 2)
+            if log.duration == duration:
+                continue
+            if log.status == Status.AGREE and log.type is not None and log.type.name == '特休假':
+                LeaveLedger.adjust(log.staff_id, (log.duration - duration)/8, log.id)
+            log.duration = duration
+            db.session.add(log)
+            changed += 1
+        return changed
+
+    # 重新計算所有請假時長，以 id 分段讀取並以批次 UPDATE 寫回。
+    # 與 recompute_range 相同，已核准特休的時長有變時補記帳並調整餘額。
+    @staticmethod
+    def recompute_durations(chunk_size=1000, workers=1):
+        first, last = db.session.query(db.func.min(LeaveLog.start), db.func.max(LeaveLog.end)).one()
+        if first is None:
+            return 0
+        annual = db.session.query(LeaveType.id).filter_by(name='特休假').scalar()
+        years = WorkCalendar.snapshot(first.year, last.year)
+        stmt = LeaveLog.__table__.update() \
+            .where(LeaveLog.__table__.c.id == db.bindparam('_id')) \
+            .values(duration=db.bindparam('duration'))
+        pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        updated = 0
+        last_id = 0
+        try:
+            while True:
+                rows = db.session.query(LeaveLog.id, LeaveLog.start, LeaveLog.end, LeaveLog.duration,
+                                        LeaveLog.department_id, LeaveLog.status, LeaveLog.type_id,
+                                        LeaveLog.staff_id) \
+                    .filter(LeaveLog.id > last_id).order_by(LeaveLog.id).limit(chunk_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                spans = [(r.start, r.end, WorkSchedule.for_department(r.department_id)) for r in rows]
+                if pool:
+                    step = (len(spans) + workers - 1) // workers
+                    parts = pool.map(Time.workingHours_batch,
+                                     [spans[i:i+step] for i in range(0, len(spans), step)],
+                                     [years] * workers)
+                    seconds = [s for part in parts for s in part]
+                else:
+                    seconds = Time.workingHours_batch(spans, years)
+                changes = [(r, round(s/3600, 2)) for r, s in zip(rows, seconds) if r.duration != round(s/3600, 2)]
+                if changes:
+                    db.session.execute(stmt, [{'_id': r.id, 'duration': duration} for r, duration in changes])
+                for r, duration in changes:
+                    if r.status == Status.AGREE and annual is not None and r.type_id == annual:
+                        LeaveLedger.adjust(r.staff_id, ((r.duration or 0) - duration)/8, r.id)
+                db.session.commit()
+                updated += len(changes)
+        finally:
+            if pool:
+                pool.shutdown()
+        return updated
+
+    # 通知審核者。FLASK_REVIEW_DIGEST_INTERVAL 為 0 時立即寄信，
+    # 否則留待 send_review_digests 併入彙整信。
+    def notify_reviewer(self, reviewer):
+        self.reviewer_id = reviewer.id
+        if current_app.config['FLASK_REVIEW_DIGEST_INTERVAL']:
+            return
+        agree_token = reviewer.generate_review_leave_token(self, Status.AGREE)
+        turn_down_token = reviewer.generate_review_leave_token(self, Status.TURN_DOWN)
+        send_email(reviewer.email, '請假申請函',
+                   'email/askLeave', user=reviewer, applicant=self.staff, leaveLog=self,
+                   agree_token=agree_token, turn_down_token=turn_down_token)
+        self.notified = datetime.utcnow()
+
+    # 每位審核者一封彙整信，列出所有尚未通知的待審請假。只寄給最早一筆
+    # 已等待超過 FLASK_REVIEW_DIGEST_INTERVAL 秒的審核者，force 則全部寄出。
+    # 由排程 (flask send-review-digests) 定期呼叫。
+    @staticmethod
+    def send_review_digests(force=False):
+        if not has_request_context():
+            with current_app.test_request_context(base_url=current_app.config['FLASK_BASE_URL']):
+                return LeaveLog.send_review_digests(force)
+        pending = (LeaveLog.status == Status.UNDER_REVIEW, LeaveLog.notified.is_(None),
+                   LeaveLog.reviewer_id.isnot(None))
+        due = db.session.query(LeaveLog.reviewer_id).filter(*pending).group_by(LeaveLog.reviewer_id)
+        if not force:
+            cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['FLASK_REVIEW_DIGEST_INTERVAL'])
+            due = due.having(db.func.min(LeaveLog.timestamp) <= cutoff)
+        reviewers = {u.id: u for u in User.query.filter(User.id.in_(due.subquery()))}
+        if not reviewers:
+            return 0
+        logs = LeaveLog.query.options(db.joinedload(LeaveLog.type), db.joinedload(LeaveLog.department),
+                                      db.joinedload(LeaveLog.staff), db.joinedload(LeaveLog.agent)) \
+            .filter(*pending).filter(LeaveLog.reviewer_id.in_(list(reviewers))) \
+            .order_by(LeaveLog.reviewer_id, LeaveLog.timestamp).all()
+        now = datetime.utcnow()
+        sent = 0
+        for reviewer_id, group in itertools.groupby(logs, key=lambda l: l.reviewer_id):
+            reviewer = reviewers[reviewer_id]
+            group = list(group)
+            items = [(l, reviewer.generate_review_leave_token(l, Status.AGREE),
+                      reviewer.generate_review_leave_token(l, Status.TURN_DOWN)) for l in group]
+            if not send_email(reviewer.email, '請假申請彙整 ({})'.format(len(items)),
+                              'email/reviewDigest', user=reviewer, items=items):
+                continue
+            db.session.query(LeaveLog).filter(LeaveLog.id.in_([l.id for l in group])) \
+                .update({LeaveLog.notified: now}, synchronize_session=False)
+            sent += 1
+        db.session.commit()
+        return sent
+
+    # 審核者可處理的待審請假: 指派給他的；他若是本部門的審核者 (Department.reviewers)，
+    # 另加尚未指派審核者的本部門請假，但不含自己的請假。管理者可處理全部待審請假。
+    @staticmethod
+    def review_queue(user):
+        query = LeaveLog.query.options(db.joinedload(LeaveLog.type)) \
+            .filter(LeaveLog.status == Status.UNDER_REVIEW)
+        if not user.can(Permission.ADMIN):
+            visible = LeaveLog.reviewer_id == user.id
+            if user.department_id is not None and Department.reviewers()[0].get(user.department_id) == user.id:
+                visible = db.or_(visible, db.and_(LeaveLog.reviewer_id.is_(None),
+                                                  LeaveLog.department_id == user.department_id,
+                                                  LeaveLog.staff_id != user.id))
+            query = query.filter(visible)
+        return query
+
+    # 一次審核多筆請假，以單一查詢載入，由呼叫端在同一交易中提交。
+    # 不在 user 審核範圍內的 id 會被忽略。回傳成功更新的筆數。
+    @staticmethod
+    def review_many(user, ids, status):
+        if not ids:
+            return 0
+        logs = LeaveLog.review_queue(user).filter(LeaveLog.id.in_(ids)).order_by(LeaveLog.id).all()
+        return sum(1 for log in logs if log.update_status(status))
 
     def update_status(self, status):
         if status != Status.TURN_DOWN and status != Status.AGREE:
@@ -295,16 +709,114 @@ class LeaveLog(db.Model):
             if self.status == Status.UNDER_REVIEW or self.status == Status.TURN_DOWN:
                 if status == Status.AGREE:
                     if self.type.name == '特休假':
-                        if (self.duration/8.0) > self.staff.officalLeave:
+                        if not LeaveLedger.post(self.staff_id, LedgerType.APPROVAL, -self.duration/8, self.id):
                             flash('Insufficient vacation.')
                             return False
-                        self.staff.officalLeave = round(self.staff.officalLeave - self.duration/8, 1)
             elif self.status == Status.AGREE and status == Status.TURN_DOWN:
                 if self.type.name == '特休假':
-                    self.staff.officalLeave = round(self.staff.officalLeave + self.duration/8, 1)
+                    LeaveLedger.post(self.staff_id, LedgerType.REVERSAL, self.duration/8, self.id)
             self.status = status
         return True
 
+class LeaveLedger(db.Model):
+    __tablename__ = 'leave_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    leave_log_id = db.Column(db.Integer, db.ForeignKey('leave_logs.id'))
+    type = db.Column(db.Integer)
+    amount = db.Column(db.Float)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # 記一筆特休異動 (天)，並以單一 UPDATE 更新 users.officalLeave。
+    # 扣除時餘額不足則不記帳並回傳 False (overdraw 時照樣扣除)，不需在 Python 端上鎖。
+    # 帳本建立前就存在的使用者先補一筆期初帳，重建餘額時才不會只剩異動。
+    @staticmethod
+    def post(user_id, type, amount, leave_log_id=None, overdraw=False):
+        db.session.flush()
+        LeaveLedger.open_balances(user_id)
+        users = User.__table__
+        stmt = users.update().where(users.c.id == user_id) \
+            .values(officalLeave=users.c.officalLeave + amount)
+        if amount < 0 and not overdraw:
+            stmt = stmt.where(users.c.officalLeave >= -amount)
+        if db.session.execute(stmt).rowcount != 1:
+            return False
+        db.session.add(LeaveLedger(user_id=user_id, type=type, amount=amount, leave_log_id=leave_log_id))
+        UserCache.invalidate(user_id)
+        user = db.session.identity_map.get(identity_key(User, user_id))
+        if user is not None:
+            db.session.expire(user, ['officalLeave'])
+        return True
+
+    # 假日或班表異動造成的時長補正。已發生的事實一定要入帳，餘額不足時照樣扣到負數
+    # 並記錄警告，否則時長與餘額從此不符。餘額足夠時回傳 True。
+    @staticmethod
+    def adjust(user_id, amount, leave_log_id):
+        if LeaveLedger.post(user_id, LedgerType.ADJUSTMENT, amount, leave_log_id):
+            return True
+        current_app.logger.warning('Leave log %s: adjustment of %s days overdraws the balance of user %s.',
+                                   leave_log_id, amount, user_id)
+        LeaveLedger.post(user_id, LedgerType.ADJUSTMENT, amount, leave_log_id, overdraw=True)
+        return False
+
+    # 尚無帳目的使用者 (指定 user_id 時只看該使用者)，以目前餘額記一筆期初帳。
+    @staticmethod
+    def open_balances(user_id=None):
+        users = User.__table__
+        ledger = LeaveLedger.__table__
+        select = db.select([users.c.id, db.literal(LedgerType.OPENING), db.func.coalesce(users.c.officalLeave, 0),
+                            db.literal(datetime.utcnow())]) \
+            .where(~db.exists().where(ledger.c.user_id == users.c.id))
+        if user_id is not None:
+            select = select.where(users.c.id == user_id)
+        return db.session.execute(ledger.insert().from_select(
+            ['user_id', 'type', 'amount', 'timestamp'], select)).rowcount
+
+    # 以帳目加總重建所有使用者的餘額。
+    @staticmethod
+    def rebuild_balances():
+        users = User.__table__
+        ledger = LeaveLedger.__table__
+        total = db.select([db.func.coalesce(db.func.sum(ledger.c.amount), 0)]) \
+            .where(ledger.c.user_id == users.c.id).as_scalar()
+        return db.session.execute(users.update().values(officalLeave=total)).rowcount
+
+class PasswordHasher:
+    # 依 FLASK_PASSWORD_METHOD / FLASK_PASSWORD_SALT_LENGTH 產生密碼雜湊。
+    # FLASK_PASSWORD_WORKERS > 0 時在行程池中驗證，CPU 密集的雜湊不會佔住請求執行緒。
+    @staticmethod
+    def hash(password):
+        config = current_app.config
+        return generate_password_hash(password, method=config['FLASK_PASSWORD_METHOD'],
+                                      salt_length=config['FLASK_PASSWORD_SALT_LENGTH'])
+
+    # 以產生一次空密碼的雜湊取得設定對應的前綴 (如 pbkdf2:sha256:150000)，
+    # 省略迭代次數的設定也能正確比對。
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def prefix(method, salt_length):
+        return generate_password_hash('', method=method, salt_length=salt_length).split('$')[0]
+
+    @staticmethod
+    def outdated(pwhash):
+        config = current_app.config
+        method, _, rest = pwhash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != PasswordHasher.prefix(config['FLASK_PASSWORD_METHOD'], config['FLASK_PASSWORD_SALT_LENGTH']) \
+            or len(salt) < config['FLASK_PASSWORD_SALT_LENGTH']
+
+    @staticmethod
+    def verify(pwhash, password):
+        workers = current_app.config['FLASK_PASSWORD_WORKERS']
+        if not workers:
+            return check_password_hash(pwhash, password)
+        app = current_app._get_current_object()
+        pool = app.extensions.get('password_pool')
+        if pool is None:
+            pool = app.extensions['password_pool'] = ProcessPoolExecutor(workers)
+            atexit.register(pool.shutdown)
+        return pool.submit(check_password_hash, pwhash, password).result()
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
@@ -313,8 +825,8 @@ class User(UserMixin, db.Model):
     name = db.Column(db.String(64))
     location = db.Column(db.String(64))
     about_me = db.Column(db.Text())
-    role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
-    department_id = db.Column(db.Integer, db.ForeignKey('departments.id'))
+    role_id = db.Column(db.Integer, db.ForeignKey('roles.id'), index=True)
+    department_id = db.Column(db.Integer, db.ForeignKey('departments.id'), index=True)
     password_hash = db.Column(db.String(128))
     firstDay = db.Column(db.DateTime)
     off_leave_start = db.Column(db.DateTime)
@@ -326,16 +838,17 @@ class User(UserMixin, db.Model):
     gender = db.Column(db.Integer)
     ask_leave = db.relationship('LeaveLog',
                 foreign_keys=[LeaveLog.staff_id],
-                backref=db.backref('staff', lazy='joined'),
+                backref=db.backref('staff', lazy='select'),
                 lazy='dynamic',
                 cascade='all, delete-orphan')
     agent = db.relationship('LeaveLog',
             foreign_keys=[LeaveLog.agent_id],
-            backref=db.backref('agent', lazy='joined'),
+            backref=db.backref('agent', lazy='select'),
             lazy='dynamic',
             cascade='all, delete-orphan')
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
+    ledger = db.relationship('LeaveLedger', backref='user', lazy='dynamic')
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
@@ -348,6 +861,7 @@ class User(UserMixin, db.Model):
             self.avatar_hash = self.gravatar_hash()
         self.firstDay = datetime.strptime(datetime.today().strftime('%Y-%m-%d'), '%Y-%m-%d')
         self.off_leave_start, self.off_leave_end, self.officalLeave = OfficalLeave.newStaff(self.firstDay)
+        LeaveLedger(user=self, type=LedgerType.ACCRUAL, amount=self.officalLeave)
     
     @property
     def password(self):
@@ -355,10 +869,15 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = PasswordHasher.hash(password)
 
+    # 驗證成功且雜湊的方法或強度已過時，就以目前設定重新雜湊，由呼叫端提交。
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not PasswordHasher.verify(self.password_hash, password):
+            return False
+        if PasswordHasher.outdated(self.password_hash):
+            self.password = password
+        return True
 
     def generate_reset_token(self, expiration=3600):
         s = Serializer(current_app.config['SECRET_KEY'], expiration)
@@ -424,16 +943,76 @@ class User(UserMixin, db.Model):
         db.session.add(leaveLog)
         return True
 
+    # 新年度特休結算。off_leave_start 已是該年一月一日的使用者視為已結算，
+    # 因此中斷後重新執行不會重複結算。
+    # 結算帳 (新額度 - 目前餘額) 以 INSERT ... SELECT 在資料庫端計算，餘額再加上這筆帳，
+    # 兩者條件相同，中途核准的請假也不會讓餘額與帳目不符。
+    @staticmethod
+    def rollover_leave(year, chunk_size=1000, dry_run=False):
+        first = datetime(year, 1, 1)
+        pending = db.or_(User.off_leave_start.is_(None), User.off_leave_start < first)
+        if not dry_run:
+            LeaveLedger.open_balances()
+        now = datetime.utcnow()
+        users = User.__table__
+        ledger = LeaveLedger.__table__
+        target = db.and_(users.c.id == db.bindparam('_id'), pending)
+        # 帳本與餘額使用同一個差額運算式，在同一個交易中依相同的舊餘額計算，
+        # 不需以時間戳記找回剛寫入的帳本列 (MySQL DATETIME 會截去小數秒)。
+        amount = db.bindparam('leave', type_=db.Float) - db.func.coalesce(users.c.officalLeave, 0)
+        accrual = db.select([users.c.id, db.literal(LedgerType.ACCRUAL), amount, db.literal(now)]).where(target)
+        insert = ledger.insert().from_select(['user_id', 'type', 'amount', 'timestamp'], accrual)
+        stmt = users.update().where(target) \
+            .values(off_leave_start=db.bindparam('start'), off_leave_end=db.bindparam('end'),
+                    officalLeave=db.func.coalesce(users.c.officalLeave, 0) + amount)
+        diff = []
+        last_id = 0
+        while True:
+            query = db.session.query(User.id, User.username, User.firstDay, User.officalLeave) \
+                .filter(User.id > last_id, User.firstDay < first, pending) \
+                .order_by(User.id).limit(chunk_size)
+            # 鎖住本批使用者，兩個陳述式之間餘額不會被其他交易改動。
+            rows = (query if dry_run else query.with_for_update()).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            changes = []
+            for r in rows:
+                start, end, leave = OfficalLeave.newYear(r.firstDay, year)
+                changes.append({'_id': r.id, 'start': start, 'end': end, 'leave': leave})
+                diff.append((r.username, r.officalLeave, leave))
+            if not dry_run:
+                db.session.execute(insert, changes)
+                db.session.execute(stmt, changes)
+                db.session.commit()
+        return diff
+
+    # 請假的審核者: 本部門主管；本人即有審核權或部門沒有主管時為 FLASK_ADMIN。
+    def reviewer(self):
+        reviewers, admin = Department.reviewers()
+        reviewer_id = None if self.can(Permission.REVIEW_LEAVE) else reviewers.get(self.department_id)
+        if reviewer_id is None:
+            reviewer_id = admin
+        return load_user(reviewer_id) if reviewer_id is not None else None
+
     def can(self, perm):
+        permissions = getattr(self, '_permissions', None)
+        if permissions is not None:
+            return permissions & perm == perm
         return self.role is not None and self.role.has_permission(perm)
 
     def is_administrator(self):
         return self.can(Permission.ADMIN)
 
+    # 更新 last_seen。寫入交給 LastSeenBuffer 批次處理，距上次更新未滿
+    # FLASK_LAST_SEEN_GRANULARITY 秒則略過。
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
-        db.session.commit()
+        now = datetime.utcnow()
+        granularity = timedelta(seconds=current_app.config['FLASK_LAST_SEEN_GRANULARITY'])
+        if self.last_seen is not None and now - self.last_seen < granularity:
+            return
+        set_committed_value(self, 'last_seen', now)
+        LastSeenBuffer.get().add(self.id, now)
     
     def gravatar_hash(self):
         return hashlib.md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -447,10 +1026,55 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return '<User %r>' % self.username
 
+class LastSeenBuffer:
+    # 行程內的 last_seen 緩衝: 同一使用者的更新會被合併，
+    # 每 FLASK_LAST_SEEN_FLUSH_INTERVAL 秒或程式結束時以一次批次 UPDATE 寫回。
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushed = time.monotonic()
+        atexit.register(self.flush_at_exit)
+
+    @staticmethod
+    def get():
+        app = current_app._get_current_object()
+        buffer = app.extensions.get('last_seen')
+        if buffer is None:
+            buffer = app.extensions['last_seen'] = LastSeenBuffer(app)
+        return buffer
+
+    def add(self, user_id, seen):
+        with self.lock:
+            self.pending[user_id] = seen
+            due = time.monotonic() - self.flushed >= self.app.config['FLASK_LAST_SEEN_FLUSH_INTERVAL']
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed = time.monotonic()
+        if not pending:
+            return 0
+        users = User.__table__
+        stmt = users.update() \
+            .where(db.and_(users.c.id == db.bindparam('_id'),
+                           db.or_(users.c.last_seen.is_(None), users.c.last_seen < db.bindparam('seen')))) \
+            .values(last_seen=db.bindparam('seen'))
+        db.session.execute(stmt, [{'_id': k, 'seen': v} for k, v in pending.items()])
+        db.session.commit()
+        return len(pending)
+
+    def flush_at_exit(self):
+        with self.app.app_context():
+            self.flush()
+
 class Department(db.Model):
     __tablename__ = 'departments'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True)
+    schedule = db.Column(db.String(64))
     users = db.relationship('User', backref='department', lazy='dynamic')
     leaveLogs = db.relationship('LeaveLog', backref='department', lazy='dynamic')
                 
@@ -478,15 +1102,82 @@ class Department(db.Model):
             db.session.add(department)
         db.session.commit()
 
+    # 部門 id -> 審核者 id 的快取，以單一 users join roles 查詢建立，
+    # 每部門取 id 最小的審核者；另存 FLASK_ADMIN 的 id 作為預設審核者。
+    # 事件只清除本行程的快取，其他行程最多 FLASK_LOOKUP_CACHE_TTL 秒後重新查詢。
+    @staticmethod
+    def reviewers():
+        entry = current_app.extensions.get('reviewers')
+        if entry is None or entry[0] < time.monotonic():
+            rows = db.session.query(User.department_id, db.func.min(User.id)) \
+                .join(Role, Role.id == User.role_id) \
+                .filter(User.department_id.isnot(None),
+                        Role.permissions.op('&')(Permission.REVIEW_LEAVE) == Permission.REVIEW_LEAVE) \
+                .group_by(User.department_id)
+            email = current_app.config['FLASK_ADMIN']
+            admin = db.session.query(User.id).filter_by(email=email).scalar() if email else None
+            entry = current_app.extensions['reviewers'] = \
+                (time.monotonic() + current_app.config['FLASK_LOOKUP_CACHE_TTL'], (dict(rows), admin))
+        return entry[1]
+
+    @staticmethod
+    def invalidate_reviewers(mapper=None, connection=None, target=None):
+        current_app.extensions.pop('reviewers', None)
+
+    @staticmethod
+    def on_user_changed(mapper, connection, target):
+        state = db.inspect(target)
+        if any(state.attrs[key].history.has_changes() for key in ('role_id', 'department_id', 'email')):
+            Department.invalidate_reviewers()
+
+    # AskLeaveForm 的職務代理人選項 (id, username)，依部門快取，只查詢需要的欄位。
+    # 其他行程新增的使用者不會觸發本行程的事件，最多 FLASK_LOOKUP_CACHE_TTL 秒後出現。
+    @staticmethod
+    def agent_choices(department_id):
+        cache = current_app.extensions.setdefault('agent_choices', {})
+        entry = cache.get(department_id)
+        if entry is None or entry[0] < time.monotonic():
+            rows = db.session.query(User.id, User.username).filter(User.department_id == department_id) \
+                .order_by(User.id)
+            entry = cache[department_id] = (time.monotonic() + current_app.config['FLASK_LOOKUP_CACHE_TTL'],
+                                            tuple((id, username) for id, username in rows))
+        return entry[1]
+
+    @staticmethod
+    def invalidate_agent_choices(mapper=None, connection=None, target=None):
+        current_app.extensions.pop('agent_choices', None)
+
+    @staticmethod
+    def on_user_renamed(mapper, connection, target):
+        state = db.inspect(target)
+        if any(state.attrs[key].history.has_changes() for key in ('username', 'department_id')):
+            Department.invalidate_agent_choices()
+
+    @db.validates('schedule')
+    def validate_schedule(self, key, schedule):
+        if schedule is not None:
+            WorkSchedule.parse(schedule)
+        return schedule
+
     def supervisor(self):
-        for user in self.users:
-            if user.can(Permission.REVIEW_LEAVE):
-                return user
-        return False
+        reviewer_id = Department.reviewers()[0].get(self.id)
+        return load_user(reviewer_id) if reviewer_id is not None else False
 
     def __repr__(self):
         return '<LeaveType %r>' % self.name
 
+db.event.listen(Department, 'after_insert', WorkSchedule.invalidate)
+db.event.listen(Department, 'after_update', WorkSchedule.invalidate)
+db.event.listen(Department, 'after_delete', WorkSchedule.invalidate)
+db.event.listen(Department, 'after_insert', Department.invalidate_reviewers)
+db.event.listen(Department, 'after_delete', Department.invalidate_reviewers)
+db.event.listen(User, 'after_insert', Department.invalidate_reviewers)
+db.event.listen(User, 'after_update', Department.on_user_changed)
+db.event.listen(User, 'after_delete', Department.invalidate_reviewers)
+db.event.listen(User, 'after_insert', Department.invalidate_agent_choices)
+db.event.listen(User, 'after_update', Department.on_user_renamed)
+db.event.listen(User, 'after_delete', Department.invalidate_agent_choices)
+
 class Role(db.Model):
     __tablename__ = 'roles'
     id = db.Column(db.Integer, primary_key=True)
@@ -539,9 +1230,62 @@ class Role(db.Model):
     def __repr__(self):
         return '<Role %r>' % self.name
 
+class UserCache:
+    # login_manager.user_loader 的快取: 保存使用者欄位與角色權限，
+    # FLASK_USER_CACHE_TTL 秒內再次載入不需查詢資料庫。
+    @staticmethod
+    def _cache():
+        return current_app.extensions.setdefault('user_cache', OrderedDict())
+
+    @staticmethod
+    def get(user_id):
+        entry = UserCache._cache().get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        user = User.__mapper__.class_manager.new_instance()
+        for key, value in entry[1].items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+        user._permissions = entry[2]
+        return user
+
+    @staticmethod
+    def put(user):
+        cache = UserCache._cache()
+        cache.pop(user.id, None)
+        while len(cache) >= current_app.config['FLASK_USER_CACHE_SIZE']:
+            cache.popitem(last=False)
+        values = {c.key: getattr(user, c.key) for c in User.__mapper__.column_attrs}
+        permissions = user.role.permissions if user.role is not None else 0
+        cache[user.id] = (time.monotonic() + current_app.config['FLASK_USER_CACHE_TTL'], values, permissions)
+
+    @staticmethod
+    def invalidate(user_id=None):
+        if user_id is None:
+            UserCache._cache().clear()
+        else:
+            UserCache._cache().pop(user_id, None)
+
+    @staticmethod
+    def on_changed(mapper, connection, target):
+        UserCache.invalidate(target.id)
+
+db.event.listen(User, 'after_update', UserCache.on_changed)
+db.event.listen(User, 'after_delete', UserCache.on_changed)
+db.event.listen(Role, 'after_update', lambda mapper, connection, target: UserCache.invalidate())
+db.event.listen(Role, 'after_insert', Department.invalidate_reviewers)
+db.event.listen(Role, 'after_update', Department.invalidate_reviewers)
+db.event.listen(Role, 'after_delete', Department.invalidate_reviewers)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user = UserCache.get(int(user_id))
+    if user is None:
+        user = User.query.get(int(user_id))
+        if user is not None:
+            UserCache.put(user)
+    return user
 
 class Post(db.Model):
     __tablename__ = 'posts'
@@ -549,19 +1293,32 @@ class Post(db.Model):
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    updated = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
+    # 依 comments 重新計算 comment_count，修補事件以外的寫入造成的誤差。
+    @staticmethod
+    def rebuild_comment_counts():
+        posts = Post.__table__
+        comments = Comment.__table__
+        total = db.select([db.func.count(comments.c.id)]) \
+            .where(comments.c.post_id == posts.c.id).as_scalar()
+        return db.session.execute(posts.update().where(posts.c.comment_count != total)
+                                  .values(comment_count=total)).rowcount
+
+    ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                    'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                    'h1', 'h2', 'h3', 'p']
+
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.body_html = BodyRenderer.render(value, Post.ALLOWED_TAGS)
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)
+db.event.listen(Post, 'after_update', lambda mapper, connection, target: FragmentCache.get().evict(target.id))
+db.event.listen(Post, 'after_delete', lambda mapper, connection, target: FragmentCache.get().evict(target.id))
 
 
 class Comment(db.Model):
@@ -574,12 +1331,121 @@ class Comment(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
 
+    ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
+                    'strong']
+
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
-                        'strong']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.body_html = BodyRenderer.render(value, Comment.ALLOWED_TAGS)
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+
+
+class BodyRenderer:
+    # markdown 轉成 HTML 後以 bleach 過濾標籤並加上連結。
+    # markdown 與 bleach 只在需要轉換時才載入，縮短開機時間。
+    @staticmethod
+    def render(body, tags):
+        from markdown import markdown
+        import bleach
+        return bleach.linkify(bleach.clean(
+            markdown(body, output_format='html'),
+            tags=tags, strip=True))
+
+    # 以新的 ALLOWED_TAGS 或 bleach 版本重新產生 model (Post 或 Comment) 的 body_html。
+    # 依 id 分段讀取，相同內文以 SHA-1 記憶只轉換一次，其餘交給行程池，
+    # 只以批次 UPDATE 寫回結果有變的資料列。回傳 (讀取筆數, 更新筆數)。
+    @staticmethod
+    def rerender(model, chunk_size=1000, workers=1, memo_size=10000):
+        table = model.__table__
+        stmt = table.update() \
+            .where(table.c.id == db.bindparam('_id')) \
+            .values(body_html=db.bindparam('body_html'))
+        pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        memo = {}
+        scanned = updated = 0
+        last_id = 0
+        try:
+            while True:
+                rows = db.session.query(model.id, model.body, model.body_html) \
+                    .filter(model.id > last_id, model.body.isnot(None)) \
+                    .order_by(model.id).limit(chunk_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                if len(memo) > memo_size:
+                    memo.clear()
+                digests = [hashlib.sha1(r.body.encode('utf-8')).digest() for r in rows]
+                todo = {}
+                for d, r in zip(digests, rows):
+                    if d not in memo:
+                        todo[d] = r.body
+                if todo:
+                    tags = [model.ALLOWED_TAGS] * len(todo)
+                    if pool:
+                        html = pool.map(BodyRenderer.render, todo.values(), tags,
+                                        chunksize=max(1, len(todo) // (workers * 4)))
+                    else:
+                        html = map(BodyRenderer.render, todo.values(), tags)
+                    memo.update(zip(todo, html))
+                changes = [{'_id': r.id, 'body_html': memo[d]}
+                           for r, d in zip(rows, digests) if r.body_html != memo[d]]
+                if changes:
+                    db.session.execute(stmt, changes)
+                db.session.commit()
+                scanned += len(rows)
+                updated += len(changes)
+        finally:
+            if pool:
+                pool.shutdown()
+        return scanned, updated
+
+
+class CommentCounter:
+    # 新增、刪除或搬移留言時，在同一個 flush 中以 UPDATE posts SET comment_count = comment_count ± 1
+    # 維護計數，並同步 session 中已載入的 Post，不需重新查詢。
+    @staticmethod
+    def add(connection, target, post_id, delta):
+        if post_id is None:
+            return
+        posts = Post.__table__
+        connection.execute(posts.update().where(posts.c.id == post_id)
+                           .values(comment_count=posts.c.comment_count + delta))
+        FragmentCache.get().evict(post_id)
+        session = db.inspect(target).session
+        post = session.identity_map.get(identity_key(Post, post_id)) if session is not None else None
+        if post is not None and 'comment_count' in post.__dict__:
+            set_committed_value(post, 'comment_count', post.comment_count + delta)
+
+    @staticmethod
+    def after_insert(mapper, connection, target):
+        CommentCounter.add(connection, target, target.post_id, 1)
+
+    @staticmethod
+    def after_delete(mapper, connection, target):
+        CommentCounter.add(connection, target, target.post_id, -1)
+
+    # 搬移留言時舊的 post_id 可能未載入，直接從資料列讀取。
+    @staticmethod
+    def before_update(mapper, connection, target):
+        if not db.inspect(target).attrs.post_id.history.has_changes():
+            return
+        comments = Comment.__table__
+        old = connection.execute(db.select([comments.c.post_id]).where(comments.c.id == target.id)).scalar()
+        if old != target.post_id:
+            CommentCounter.add(connection, target, old, -1)
+            CommentCounter.add(connection, target, target.post_id, 1)
+
+    # 隱藏或恢復留言時更新 posts.updated，讓文章頁的 ETag 失效。
+    @staticmethod
+    def after_update(mapper, connection, target):
+        if target.post_id is None or not db.inspect(target).attrs.disabled.history.has_changes():
+            return
+        posts = Post.__table__
+        connection.execute(posts.update().where(posts.c.id == target.post_id)
+                           .values(updated=datetime.utcnow()))
+
+db.event.listen(Comment, 'after_insert', CommentCounter.after_insert)
+db.event.listen(Comment, 'after_delete', CommentCounter.after_delete)
+db.event.listen(Comment, 'before_update', CommentCounter.before_update)
+db.event.listen(Comment, 'after_update', CommentCounter.after_update)
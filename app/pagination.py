@@ -0,0 +1,77 @@
+import base64
+import json
+import time
+from datetime import datetime
+from flask import current_app, request
+from . import db
+
+
+class KeysetPagination:
+    # 以排序鍵 (keyset) 分頁: 以上一頁最後一筆的鍵值作為條件，不需 OFFSET，
+    # 第 500 頁與第 1 頁的成本相同。keys 為 [(欄位, 是否遞減)]，最後一個欄位須唯一。
+    # cursor 為不透明字串，記錄方向與邊界鍵值；總筆數只在 with_total 時才計算。
+    def __init__(self, query, keys, per_page, cursor=None, with_total=False):
+        self.keys = keys
+        self.per_page = per_page
+        self.cursor = cursor
+        direction, values = self.decode(cursor)
+        backwards = direction == 'prev'
+        page = query.filter(self.beyond(values, backwards)) if values is not None else query
+        order = [column.asc() if desc == backwards else column.desc() for column, desc in keys]
+        items = page.order_by(*order).limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+        self.items = items
+        self.has_prev = bool(items) and (more if backwards else values is not None)
+        self.has_next = bool(items) and (values is not None if backwards else more)
+        self.prev_cursor = self.encode('prev', items[0]) if self.has_prev else None
+        self.next_cursor = self.encode('next', items[-1]) if self.has_next else None
+        self.total = KeysetPagination.count(query) if with_total else None
+
+    # 排序在 values 之後 (backwards 時為之前) 的資料列。
+    def beyond(self, values, backwards):
+        clauses = []
+        for i, (column, desc) in enumerate(self.keys):
+            bound = column < values[i] if desc != backwards else column > values[i]
+            clauses.append(db.and_(*[c == v for (c, d), v in zip(self.keys[:i], values[:i])], bound))
+        return db.or_(*clauses)
+
+    def encode(self, direction, item):
+        values = [getattr(item, column.key) for column, desc in self.keys]
+        values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+        return base64.urlsafe_b64encode(json.dumps([direction, values]).encode('utf-8')).decode('ascii')
+
+    # 無法解析的 cursor 視為第一頁。
+    def decode(self, cursor):
+        if not cursor:
+            return 'next', None
+        try:
+            direction, values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            if direction not in ('next', 'prev') or len(values) != len(self.keys):
+                raise ValueError(cursor)
+            values = [datetime.fromisoformat(v) if isinstance(column.type, db.DateTime) else v
+                      for (column, desc), v in zip(self.keys, values)]
+        except (ValueError, TypeError):
+            return 'next', None
+        return direction, values
+
+    # 總筆數以查詢語句為鍵快取 FLASK_PAGE_COUNT_TTL 秒，翻頁時不會重複 COUNT(*)。
+    @staticmethod
+    def count(query):
+        cache = current_app.extensions.setdefault('page_counts', {})
+        statement = query.order_by(None).statement.compile()
+        key = (str(statement), tuple(sorted(statement.params.items())))
+        entry = cache.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if len(cache) >= 1024:
+                cache.clear()
+            entry = cache[key] = (time.monotonic() + current_app.config['FLASK_PAGE_COUNT_TTL'],
+                                  query.order_by(None).count())
+        return entry[1]
+
+
+def paginate(query, keys, per_page):
+    return KeysetPagination(query, keys, per_page, cursor=request.args.get('cursor'),
+                            with_total=request.args.get('count', 0, type=int) == 1)
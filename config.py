@@ -12,12 +12,31 @@ class Config:
     FLASK_MAIL_SUBJECT_PREFIX = '[Leave System]'
     FLASK_MAIL_SENDER = 'Leave System Admin {}'.format(os.environ.get('MAIL_USERNAME'))
     FLASK_ADMIN = os.environ.get('FLASK_ADMIN')
+    FLASK_MAIL_WORKERS = 2
+    FLASK_MAIL_QUEUE_SIZE = 100
+    FLASK_MAIL_QUEUE_TIMEOUT = 10
+    FLASK_MAIL_IDLE_TIMEOUT = 5
+    FLASK_MAIL_RETRIES = 3
+    FLASK_MAIL_RETRY_DELAY = 1
+    FLASK_PASSWORD_METHOD = os.environ.get('FLASK_PASSWORD_METHOD', 'pbkdf2:sha256:150000')
+    FLASK_PASSWORD_SALT_LENGTH = 16
+    FLASK_PASSWORD_WORKERS = int(os.environ.get('FLASK_PASSWORD_WORKERS', '0'))
+    FLASK_REVIEW_DIGEST_INTERVAL = int(os.environ.get('FLASK_REVIEW_DIGEST_INTERVAL', '0'))
+    FLASK_BASE_URL = os.environ.get('FLASK_BASE_URL', 'http://localhost:5000')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     FLASK_LEAVE_LOG_PER_PAGE = 10
     FLASK_USER_PER_PAGE = 10
     FLASK_WORK_OR_HOLIDAY_PER_PAGE = 10
     FLASK_POSTS_PER_PAGE = 20
     FLASK_COMMENTS_PER_PAGE = 30
+    FLASK_PAGE_COUNT_TTL = 60
+    FLASK_FRAGMENT_CACHE_SIZE = 1024
+    FLASK_CONDITIONAL_MAX_AGE = 1800
+    FLASK_LOOKUP_CACHE_TTL = 60
+    FLASK_LAST_SEEN_FLUSH_INTERVAL = 30
+    FLASK_LAST_SEEN_GRANULARITY = 60
+    FLASK_USER_CACHE_TTL = 60
+    FLASK_USER_CACHE_SIZE = 1024
 
     @staticmethod
     def init_app(app):
@@ -33,6 +52,8 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite://'
     WTF_CSRF_ENABLED = False
+    FLASK_LAST_SEEN_FLUSH_INTERVAL = 0
+    FLASK_LAST_SEEN_GRANULARITY = 0
 
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
@@ -9,20 +9,22 @@ if os.environ.get('FLASK_COVERAGE'):
 import sys
 
 import click
-from flask_migrate import Migrate, upgrade
 from app import create_app, db
-from app.models import Permission, Gender, Status, Time, OfficalLeave, LeaveType, LeaveLog, User, Department, Role, Post, Comment
+from app.models import Permission, Gender, Status, Time, OfficalLeave, LeaveType, LeaveLog, LeaveLedger, WorkOrHoliday, User, Department, Role, Post, Comment, BodyRenderer
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
 
-migrate = Migrate(app, db)
+# Flask-Migrate 會載入 alembic，只有 flask 指令需要；worker 開機時略過。
+if os.environ.get('FLASK_RUN_FROM_CLI'):
+    from flask_migrate import Migrate
+    migrate = Migrate(app, db)
 
 @app.shell_context_processor
 def make_shell_context():
     return dict(db=db, 
                 Permission=Permission, Gender=Gender, Status=Status,
                 Time=Time, OfficalLeave=OfficalLeave,
-                LeaveType=LeaveType, LeaveLog=LeaveLog, User=User, Department=Department, Role=Role, 
+                LeaveType=LeaveType, LeaveLog=LeaveLog, LeaveLedger=LeaveLedger, User=User, Department=Department, Role=Role, 
                 Post=Post, Comment=Comment)
 
 @app.cli.command()
@@ -55,7 +57,119 @@ def test(coverage, test_names):
 
 @app.cli.command()
 def deploy():
+    from flask_migrate import upgrade
     upgrade()
     Role.insert_roles()
     LeaveType.insert_leave_type()
-    Department.insert_department()
\ No newline at end of file
+    Department.insert_department()
+    WorkOrHoliday.rebuild_longest()
+    LeaveLedger.open_balances()
+    db.session.commit()
+
+@app.cli.command('recompute-durations')
+@click.option('--chunk-size', default=1000, help='Rows read per batch.')
+@click.option('--workers', default=os.cpu_count() or 1, help='Worker processes.')
+def recompute_durations(chunk_size, workers):
+    """Recompute the duration of every leave log."""
+    updated = LeaveLog.recompute_durations(chunk_size=chunk_size, workers=workers)
+    print('{} leave logs updated.'.format(updated))
+
+
+@app.cli.command('rollover-leave')
+@click.option('--year', type=int, required=True, help='Year to roll annual leave over to.')
+@click.option('--chunk-size', default=1000, help='Users read per batch.')
+@click.option('--dry-run', is_flag=True, help='Report the changes without writing them.')
+def rollover_leave(year, chunk_size, dry_run):
+    """Recompute annual leave of every user for a new year."""
+    diff = User.rollover_leave(year, chunk_size=chunk_size, dry_run=dry_run)
+    for username, old, new in diff:
+        print('{}: {} -> {}'.format(username, old, new))
+    print('{} users {}.'.format(len(diff), 'to update' if dry_run else 'updated'))
+
+
+@app.cli.command('rebuild-balances')
+def rebuild_balances():
+    """Rebuild annual leave balances from the leave ledger."""
+    opened = LeaveLedger.open_balances()
+    rebuilt = LeaveLedger.rebuild_balances()
+    db.session.commit()
+    print('{} opening entries added, {} balances rebuilt.'.format(opened, rebuilt))
+
+
+@app.cli.command('send-review-digests')
+@click.option('--force', is_flag=True, help='Send every pending request, however recent.')
+def send_review_digests(force):
+    """Send digest emails of pending leave requests to reviewers."""
+    sent = LeaveLog.send_review_digests(force=force)
+    print('{} digest emails sent.'.format(sent))
+
+
+@app.cli.command('rebuild-comment-counts')
+def rebuild_comment_counts():
+    """Recount the comments of every post."""
+    fixed = Post.rebuild_comment_counts()
+    db.session.commit()
+    print('{} posts fixed.'.format(fixed))
+
+
+@app.cli.command('rerender-bodies')
+@click.option('--chunk-size', default=1000, help='Rows read per batch.')
+@click.option('--workers', default=os.cpu_count() or 1, help='Worker processes.')
+def rerender_bodies(chunk_size, workers):
+    """Regenerate body_html of every post and comment."""
+    import time
+    for model in (Post, Comment):
+        start = time.perf_counter()
+        scanned, updated = BodyRenderer.rerender(model, chunk_size=chunk_size, workers=workers)
+        elapsed = time.perf_counter() - start
+        print('{}: {} rows read, {} updated in {:.1f}s ({:.0f} rows/sec).'.format(
+            model.__tablename__, scanned, updated, elapsed, scanned / elapsed if elapsed else 0))
+
+
+@app.cli.command()
+@click.option('--iterations', default=1000, help='Calls measured per function.')
+@click.option('--output', type=click.File('w'), help='Write the results as JSON to this file.')
+@click.option('--baseline', type=click.File('r'), help='JSON results of an earlier run to compare against.')
+@click.option('--threshold', default=0.2, help='Allowed p50 slowdown against the baseline, as a ratio.')
+def bench(iterations, output, baseline, threshold):
+    """Run the calculation benchmarks."""
+    import json
+    from app import bench as benchmarks
+    results = benchmarks.run(iterations)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    if baseline:
+        regressions = benchmarks.compare(results, json.load(baseline), threshold)
+        for name, before, after in regressions:
+            print('{}: p50 {}us -> {}us'.format(name, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+@app.cli.command('import-report')
+@click.option('--limit', default=20, help='Number of modules to list.')
+def import_report(limit):
+    """List the slowest modules imported at worker boot."""
+    from app import bench as benchmarks
+    total, modules = benchmarks.import_times()
+    modules.sort(key=lambda m: m[2], reverse=True)
+    print('{:>10} {:>10}  module'.format('self ms', 'total ms'))
+    for name, own, cumulative in modules[:limit]:
+        print('{:10.1f} {:10.1f}  {}'.format(own * 1000, cumulative * 1000, name))
+    print('Total: {:.1f} ms'.format(total * 1000))
+
+
+@app.cli.command('bench-login')
+@click.option('--method', multiple=True, help='Password hash method, may be repeated. Defaults to the configured one.')
+@click.option('--workers', type=int, multiple=True, help='Verifier processes, may be repeated. 0 verifies in the calling thread.')
+@click.option('--count', default=100, help='Logins per setting.')
+@click.option('--threads', default=8, help='Concurrent request threads.')
+def bench_login(method, workers, count, threads):
+    """Report password verifications per second for each hashing setting."""
+    from app import bench as benchmarks
+    methods = method or [app.config['FLASK_PASSWORD_METHOD']]
+    workers = workers or [0, os.cpu_count() or 1]
+    results = benchmarks.logins([(m, w) for m in methods for w in workers], count=count, threads=threads)
+    for name, rate in results.items():
+        print('{}: {} logins/sec'.format(name, rate))
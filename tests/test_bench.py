@@ -0,0 +1,45 @@
+import unittest
+from app import bench
+
+# 匯入 flask_leave_system (worker 開機) 的時間上限，秒。取 IMPORT_RUNS 次中最快的一次比較，
+# 排除機器忙碌時的單次誤差。
+IMPORT_BUDGET = 1.0
+IMPORT_RUNS = 3
+
+class BenchTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_run(self):
+        results = bench.run(iterations=20)
+        for name in ['Time.workingHours_days', 'Time.dateInterval', 'OfficalLeave.newYear', 'LeaveLog.__init__']:
+            self.assertTrue(results[name]['ops'] > 0)
+            self.assertTrue(results[name]['p50'] <= results[name]['p99'])
+
+    def test_holiday_lookups(self):
+        results = bench.holiday_lookups(sizes=(20, 200), count=5)
+        self.assertEqual(['WorkOrHoliday.find_overlapping[20]', 'WorkOrHoliday.find_overlapping[200]'], list(results))
+        self.assertTrue(all(r['ops'] > 0 for r in results.values()))
+
+    def test_logins(self):
+        results = bench.logins([('pbkdf2:sha256:1000', 0), ('pbkdf2:sha256:1000', 1)], count=10, threads=2)
+        self.assertEqual(['pbkdf2:sha256:1000 workers=0', 'pbkdf2:sha256:1000 workers=1'], list(results))
+        self.assertTrue(all(rate > 0 for rate in results.values()))
+
+    def test_import_budget(self):
+        runs = [bench.import_times() for i in range(IMPORT_RUNS)]
+        names = set(name.strip() for total, modules in runs for name, own, cumulative in modules)
+        for lazy in ['alembic', 'flask_migrate', 'markdown', 'bleach']:
+            self.assertFalse(lazy in names, lazy)
+        self.assertLess(min(total for total, modules in runs), IMPORT_BUDGET)
+
+    def test_compare(self):
+        baseline = {'a': {'ops': 100, 'p50': 10.0, 'p99': 20.0},
+                    'b': {'ops': 100, 'p50': 10.0, 'p99': 20.0}}
+        results = {'a': {'ops': 90, 'p50': 11.0, 'p99': 20.0},
+                   'b': {'ops': 50, 'p50': 13.0, 'p99': 40.0}}
+        self.assertEqual([('b', 10.0, 13.0)], bench.compare(results, baseline, 0.2))
+        self.assertEqual([], bench.compare(results, baseline, 0.5))
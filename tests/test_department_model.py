@@ -1,6 +1,7 @@
 import unittest
 from app import create_app, db
-from app.models import Department
+from datetime import datetime
+from app.models import Department, LeaveLog, WorkSchedule, User, Role, LeaveType, Gender
 
 class DepartmentModelTestCase(unittest.TestCase):
     def setUp(self):
@@ -26,4 +27,129 @@ class DepartmentModelTestCase(unittest.TestCase):
         keys = ['人資部門', '資訊科技部門', '研發部門', '公關部門', '客服部', '行銷部', '培訓部', '銷售部', '行政部門', '會計部門']
         for k in keys:
             department = Department.query.filter_by(name=k).first()
-            self.assertTrue(department is not None)
\ No newline at end of file
+            self.assertTrue(department is not None)
+
+    def test_schedule(self):
+        department = Department.query.filter_by(name='客服部').first()
+        self.assertTrue(department.schedule is None)
+        self.assertTrue(WorkSchedule.for_department(department.id) is WorkSchedule.DEFAULT)
+        department.schedule = '13:00-17:00,18:00-22:00'
+        db.session.add(department)
+        db.session.commit()
+        self.assertEqual(8*60*60, WorkSchedule.for_department(department.id).total)
+        l = LeaveLog(start=datetime(2021, 4, 6, 13, 0, 0), end=datetime(2021, 4, 7, 17, 0, 0),
+                     department_id=department.id)
+        self.assertEqual(12.0, l.duration)
+
+        # 跨夜班: 22:00 ~ 隔天 06:00。
+        department.schedule = '00:00-06:00,22:00-24:00'
+        db.session.commit()
+        l = LeaveLog(start=datetime(2021, 4, 6, 22, 0, 0), end=datetime(2021, 4, 8, 6, 0, 0),
+                     department_id=department.id)
+        self.assertEqual(16.0, l.duration)
+        with self.assertRaises(ValueError):
+            department.schedule = '22:00-06:00'
+
+    def test_schedule_ttl(self):
+        # 其他行程的異動不會觸發本行程的事件，只能等快取過期。
+        self.app.config['FLASK_LOOKUP_CACHE_TTL'] = 0
+        department = Department.query.filter_by(name='客服部').first()
+        self.assertTrue(WorkSchedule.for_department(department.id) is WorkSchedule.DEFAULT)
+        db.session.execute(Department.__table__.update().values(schedule='07:00-15:00'))
+        self.assertEqual(7*60*60, WorkSchedule.for_department(department.id).start)
+
+    def test_reviewers(self):
+        Role.insert_roles()
+        self.app.config['FLASK_ADMIN'] = 'admin@example.com'
+        supervisor = Role.query.filter_by(name='Supervisor').first()
+        admin = User(email='admin@example.com', username='admin', password='cat', department_id=2)
+        boss = User(email='boss@example.com', username='boss', password='cat', department_id=1, role=supervisor)
+        john = User(email='john@example.com', username='john', password='cat', department_id=1)
+        susan = User(email='susan@example.com', username='susan', password='cat', department_id=3)
+        db.session.add_all([admin, boss, john, susan])
+        db.session.commit()
+        self.assertEqual(boss.id, john.reviewer().id)
+        self.assertEqual(admin.id, boss.reviewer().id)
+        self.assertEqual(admin.id, susan.reviewer().id)
+        self.assertEqual(boss.id, Department.query.get(1).supervisor().id)
+        self.assertFalse(Department.query.get(3).supervisor())
+
+        statements = []
+        def before_execute(conn, clauseelement, multiparams, params):
+            statements.append(clauseelement)
+        db.event.listen(db.engine, 'before_execute', before_execute)
+        try:
+            john.reviewer()
+            susan.reviewer()
+        finally:
+            db.event.remove(db.engine, 'before_execute', before_execute)
+        self.assertEqual(0, len(statements))
+
+        susan.role = supervisor
+        db.session.commit()
+        self.assertEqual(susan.id, Department.query.get(3).supervisor().id)
+        boss.department_id = 3
+        db.session.commit()
+        self.assertEqual(admin.id, john.reviewer().id)
+        supervisor.permissions = 0
+        db.session.commit()
+        self.assertFalse(Department.query.get(3).supervisor())
+
+    def test_reviewers_ttl(self):
+        # 其他行程降級主管時本行程收不到事件，快取過期後才看得到。
+        Role.insert_roles()
+        supervisor = Role.query.filter_by(name='Supervisor').first()
+        boss = User(email='boss@example.com', username='boss', password='cat', department_id=1, role=supervisor)
+        db.session.add(boss)
+        db.session.commit()
+        staff = Role.query.filter_by(default=True).first()
+        self.assertEqual(boss.id, Department.reviewers()[0].get(1))
+        db.session.execute(User.__table__.update().values(role_id=staff.id))
+        self.assertEqual(boss.id, Department.reviewers()[0].get(1))
+        self.app.config['FLASK_LOOKUP_CACHE_TTL'] = 0
+        Department.invalidate_reviewers()
+        self.assertEqual(None, Department.reviewers()[0].get(1))
+        db.session.execute(User.__table__.update().values(role_id=supervisor.id))
+        self.assertEqual(boss.id, Department.reviewers()[0].get(1))
+
+    def test_ask_leave_choices(self):
+        Role.insert_roles()
+        LeaveType.insert_leave_type()
+        john = User(email='john@example.com', username='john', password='cat', department_id=1)
+        susan = User(email='susan@example.com', username='susan', password='cat', department_id=2)
+        db.session.add_all([john, susan])
+        db.session.commit()
+        self.assertEqual(8, len(LeaveType.choices(Gender.FEMALE)))
+        self.assertEqual(7, len(LeaveType.choices(Gender.MALE)))
+        self.assertFalse('生理假' in [name for id, name in LeaveType.choices(Gender.MALE)])
+        self.assertEqual(((john.id, 'john'),), Department.agent_choices(1))
+
+        statements = []
+        def before_execute(conn, clauseelement, multiparams, params):
+            statements.append(clauseelement)
+        db.event.listen(db.engine, 'before_execute', before_execute)
+        try:
+            LeaveType.choices(Gender.MALE)
+            Department.agent_choices(1)
+        finally:
+            db.event.remove(db.engine, 'before_execute', before_execute)
+        self.assertEqual(0, len(statements))
+
+        susan.department_id = 1
+        db.session.commit()
+        self.assertEqual(((john.id, 'john'), (susan.id, 'susan')), Department.agent_choices(1))
+        db.session.add(User(email='bob@example.com', username='bob', password='cat', department_id=1))
+        db.session.commit()
+        self.assertEqual(3, len(Department.agent_choices(1)))
+        self.assertEqual((), Department.agent_choices(2))
+
+    def test_ask_leave_choices_ttl(self):
+        # 其他行程新增的使用者與假別不會觸發本行程的事件，快取過期後才看得到。
+        self.app.config['FLASK_LOOKUP_CACHE_TTL'] = 0
+        LeaveType.insert_leave_type()
+        self.assertEqual((), Department.agent_choices(1))
+        count = len(LeaveType.choices(Gender.MALE))
+        db.session.execute(User.__table__.insert().values(username='bob', department_id=1))
+        db.session.execute(LeaveType.__table__.insert().values(name='test', permissions=Gender.MALE))
+        self.assertEqual(1, len(Department.agent_choices(1)))
+        self.assertEqual(count + 1, len(LeaveType.choices(Gender.MALE)))
@@ -0,0 +1,84 @@
+import socketserver
+import threading
+import unittest
+from flask_mail import Message
+from app import create_app
+from app.email import EmailQueue
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost')
+        while True:
+            line = self.rfile.readline().decode('ascii').strip()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == 'DATA':
+                self.reply('354 go ahead')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.reply('250 ok')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+class EmailTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+        self.server.daemon_threads = True
+        self.server.connections = self.server.messages = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.app = create_app('testing')
+        self.app.config.update(FLASK_MAIL_WORKERS=1, FLASK_MAIL_RETRY_DELAY=0)
+        state = self.app.extensions['mail']
+        state.suppress = False
+        state.server, state.port = self.server.server_address
+        state.use_tls = False
+        state.username = None
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def message(self):
+        return Message('test', sender='admin@example.com', recipients=['john@example.com'], body='test')
+
+    def test_reuse_connection(self):
+        email_queue = EmailQueue.get()
+        for i in range(5):
+            self.assertTrue(email_queue.put(self.message()))
+        email_queue.shutdown()
+        self.assertEqual(5, self.server.messages)
+        self.assertEqual(1, self.server.connections)
+        stats = email_queue.stats()
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(5, stats['sent'])
+        self.assertEqual(0, stats['failed'])
+        self.assertTrue(stats['max_latency'] >= stats['avg_latency'] > 0)
+
+    def test_retry(self):
+        self.app.extensions['mail'].port = 1
+        self.app.config['FLASK_MAIL_RETRIES'] = 1
+        email_queue = EmailQueue.get()
+        self.assertTrue(email_queue.put(self.message()))
+        email_queue.shutdown()
+        self.assertEqual(1, email_queue.stats()['failed'])
+        self.assertEqual(0, email_queue.stats()['sent'])
+
+    def test_backpressure(self):
+        self.app.config.update(FLASK_MAIL_WORKERS=0, FLASK_MAIL_QUEUE_SIZE=1, FLASK_MAIL_QUEUE_TIMEOUT=0.01)
+        email_queue = EmailQueue.get()
+        self.assertTrue(email_queue.put(self.message()))
+        self.assertFalse(email_queue.put(self.message()))
+        self.assertEqual(1, email_queue.stats()['depth'])
+        self.assertEqual(1, email_queue.stats()['dropped'])
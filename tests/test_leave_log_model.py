@@ -1,7 +1,8 @@
 import unittest
 from datetime import datetime
-from app import create_app, db
-from app.models import User, LeaveType, LeaveLog, Status
+from app import create_app, db, mail
+from app.email import EmailQueue
+from app.models import User, Role, LeaveType, LeaveLog, LeaveLedger, LedgerType, Status, Time, WorkOrHoliday
 
 class LeaveTypeModelTestCase(unittest.TestCase):
     def setUp(self):
@@ -33,6 +34,276 @@ class LeaveTypeModelTestCase(unittest.TestCase):
         self.assertTrue(l.staff_id is None)
         self.assertTrue(l.agent_id is None)
 
+    def test_working_hours_batch(self):
+        fmt = '%Y-%m-%d %H:%M:%S'
+        spans = [
+            ('2021-04-01 10:30:00', '2021-04-06 14:00:00'),
+            ('2021-04-01 17:00:00', '2021-04-30 10:00:00'),
+            ('2021-04-09 09:00:00', '2021-04-09 18:00:00'),
+            ('2021-04-10 09:00:00', '2021-04-10 18:00:00'),
+            ('2020-12-30 13:00:00', '2021-01-04 12:00:00'),
+        ]
+        spans = [(datetime.strptime(s, fmt), datetime.strptime(e, fmt)) for s, e in spans]
+        self.assertEqual([26.5*3600, 162.0*3600, 8*3600, 0, 24*3600], Time.workingHours_batch(spans))
+        for (s, e), a in zip(spans, Time.workingHours_batch(spans)):
+            self.assertEqual(a, Time.workingHours_days(s, e))
+
+    def test_overlapping(self):
+        u = User(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        l1 = LeaveLog(start=datetime(2021, 4, 6, 9, 0, 0), end=datetime(2021, 4, 7, 18, 0, 0), staff_id=u.id)
+        l2 = LeaveLog(start=datetime(2021, 4, 12, 9, 0, 0), end=datetime(2021, 4, 12, 18, 0, 0), staff_id=u.id,
+                      status=Status.TURN_DOWN)
+        db.session.add_all([l1, l2])
+        db.session.commit()
+        l = [
+            (datetime(2021, 4, 7, 13, 0, 0), datetime(2021, 4, 8, 18, 0, 0), [l1]),
+            (datetime(2021, 4, 1, 9, 0, 0), datetime(2021, 4, 30, 18, 0, 0), [l1]),
+            (datetime(2021, 4, 8, 9, 0, 0), datetime(2021, 4, 9, 18, 0, 0), []),
+            (datetime(2021, 4, 12, 9, 0, 0), datetime(2021, 4, 12, 18, 0, 0), []),
+        ]
+        for start, end, a in l:
+            self.assertEqual(a, LeaveLog.overlapping(u.id, start, end).all())
+            self.assertEqual(bool(a), LeaveLog.has_overlap(u.id, start, end))
+        self.assertFalse(LeaveLog.has_overlap(u.id + 1, l1.start, l1.end))
+
+    def test_update_status_ledger(self):
+        u = User(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        initial = u.officalLeave
+        self.assertTrue(LeaveLedger.post(u.id, LedgerType.ACCRUAL, 2.0))
+        db.session.commit()
+        self.assertAlmostEqual(initial + 2.0, u.officalLeave)
+        typeID = LeaveType.query.filter_by(name='特休假').first().id
+        l1 = LeaveLog(start=datetime(2021, 4, 6, 9, 0, 0), end=datetime(2021, 4, 7, 18, 0, 0), staff_id=u.id, type_id=typeID)
+        l2 = LeaveLog(start=datetime(2021, 4, 12, 9, 0, 0), end=datetime(2021, 4, 16, 18, 0, 0), staff_id=u.id, type_id=typeID)
+        db.session.add_all([l1, l2])
+        db.session.commit()
+        with self.app.test_request_context('/'):
+            self.assertTrue(l1.update_status(Status.AGREE))
+            db.session.commit()
+            self.assertAlmostEqual(initial, u.officalLeave)
+            self.assertFalse(l2.update_status(Status.AGREE))
+            db.session.commit()
+            self.assertAlmostEqual(initial, u.officalLeave)
+            self.assertTrue(l1.update_status(Status.TURN_DOWN))
+            db.session.commit()
+            self.assertAlmostEqual(initial + 2.0, u.officalLeave)
+        self.assertEqual([LedgerType.ACCRUAL, LedgerType.ACCRUAL, LedgerType.APPROVAL, LedgerType.REVERSAL],
+                         [e.type for e in u.ledger.order_by(LeaveLedger.id)])
+
+        u.officalLeave = 0
+        db.session.commit()
+        LeaveLedger.rebuild_balances()
+        db.session.commit()
+        db.session.refresh(u)
+        self.assertAlmostEqual(initial + 2.0, u.officalLeave)
+
+    def test_open_balances(self):
+        u = User(password='cat')
+        u.officalLeave = 4.5
+        db.session.add(u)
+        db.session.commit()
+        u.ledger.delete()
+        db.session.commit()
+        self.assertEqual(1, LeaveLedger.open_balances())
+        self.assertEqual(0, LeaveLedger.open_balances())
+        LeaveLedger.rebuild_balances()
+        db.session.commit()
+        db.session.refresh(u)
+        self.assertEqual(4.5, u.officalLeave)
+
+    def test_post_opens_legacy_balance(self):
+        u = User(password='cat')
+        u.officalLeave = 10.0
+        db.session.add(u)
+        db.session.commit()
+        u.ledger.delete()
+        db.session.commit()
+        self.assertTrue(LeaveLedger.post(u.id, LedgerType.APPROVAL, -1.0))
+        db.session.commit()
+        self.assertEqual([LedgerType.OPENING, LedgerType.APPROVAL], [e.type for e in u.ledger.order_by(LeaveLedger.id)])
+        self.assertEqual(0, LeaveLedger.open_balances())
+        LeaveLedger.rebuild_balances()
+        db.session.commit()
+        db.session.refresh(u)
+        self.assertEqual(9.0, u.officalLeave)
+
+    def test_recompute_range(self):
+        u = User(password='cat')
+        u.officalLeave = 5.0
+        db.session.add(u)
+        db.session.commit()
+        typeID = LeaveType.query.filter_by(name='特休假').first().id
+        agreed = LeaveLog(start=datetime(2021, 4, 5, 9, 0, 0), end=datetime(2021, 4, 6, 18, 0, 0),
+                          staff_id=u.id, type_id=typeID, status=Status.AGREE)
+        pending = LeaveLog(start=datetime(2021, 4, 6, 9, 0, 0), end=datetime(2021, 4, 6, 18, 0, 0),
+                           staff_id=u.id, type_id=typeID)
+        other = LeaveLog(start=datetime(2021, 4, 12, 9, 0, 0), end=datetime(2021, 4, 12, 18, 0, 0),
+                         staff_id=u.id, type_id=typeID, status=Status.AGREE)
+        db.session.add_all([agreed, pending, other])
+        db.session.commit()
+        self.assertEqual(16.0, agreed.duration)
+        start = datetime(2021, 4, 5, 0, 0, 0)
+        end = datetime(2021, 4, 5, 23, 59, 59)
+        db.session.add(WorkOrHoliday(start=start, end=end, reason='typhoon', workday=0))
+        db.session.flush()
+        self.assertEqual(1, LeaveLog.recompute_range(start, end))
+        db.session.commit()
+        self.assertEqual(8.0, agreed.duration)
+        self.assertEqual(8.0, pending.duration)
+        self.assertEqual(8.0, other.duration)
+        self.assertEqual(6.0, u.officalLeave)
+
+    def test_recompute_range_overdraw(self):
+        u = User(password='cat')
+        u.officalLeave = 0.0
+        db.session.add(u)
+        db.session.commit()
+        u.ledger.delete()
+        typeID = LeaveType.query.filter_by(name='特休假').first().id
+        holiday = WorkOrHoliday(start=datetime(2021, 4, 5, 0, 0, 0), end=datetime(2021, 4, 5, 23, 59, 59),
+                                reason='typhoon', workday=0)
+        db.session.add(holiday)
+        db.session.commit()
+        agreed = LeaveLog(start=datetime(2021, 4, 5, 9, 0, 0), end=datetime(2021, 4, 6, 18, 0, 0),
+                          staff_id=u.id, type_id=typeID, status=Status.AGREE)
+        db.session.add(agreed)
+        db.session.commit()
+        self.assertEqual(8.0, agreed.duration)
+        db.session.delete(holiday)
+        db.session.flush()
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            self.assertEqual(1, LeaveLog.recompute_range(holiday.start, holiday.end))
+        db.session.commit()
+        self.assertEqual(16.0, agreed.duration)
+        self.assertEqual(-1.0, u.officalLeave)
+        self.assertAlmostEqual(u.officalLeave, sum(e.amount for e in u.ledger))
+
+    def test_recompute_durations(self):
+        for day in range(5, 10):
+            db.session.add(LeaveLog(start=datetime(2021, 4, day, 9, 0, 0), end=datetime(2021, 4, day, 18, 0, 0)))
+        db.session.add(WorkOrHoliday(start=datetime(2021, 4, 5, 0, 0, 0), end=datetime(2021, 4, 6, 23, 59, 59),
+                                     reason='holiday', workday=0))
+        db.session.commit()
+        self.assertEqual(2, LeaveLog.recompute_durations(chunk_size=2))
+        self.assertEqual([0, 0, 8.0, 8.0, 8.0], [l.duration for l in LeaveLog.query.order_by(LeaveLog.id)])
+        self.assertEqual(0, LeaveLog.recompute_durations(chunk_size=2))
+
+    def test_recompute_durations_ledger(self):
+        u = User(password='cat')
+        u.officalLeave = 5.0
+        db.session.add(u)
+        db.session.commit()
+        u.ledger.delete()
+        typeID = LeaveType.query.filter_by(name='特休假').first().id
+        agreed = LeaveLog(start=datetime(2021, 4, 5, 9, 0, 0), end=datetime(2021, 4, 6, 18, 0, 0),
+                          staff_id=u.id, type_id=typeID, status=Status.AGREE)
+        pending = LeaveLog(start=datetime(2021, 4, 5, 9, 0, 0), end=datetime(2021, 4, 6, 18, 0, 0),
+                           staff_id=u.id, type_id=typeID)
+        db.session.add_all([agreed, pending])
+        db.session.add(WorkOrHoliday(start=datetime(2021, 4, 5, 0, 0, 0), end=datetime(2021, 4, 5, 23, 59, 59),
+                                     reason='holiday', workday=0))
+        db.session.commit()
+        self.assertEqual(2, LeaveLog.recompute_durations(chunk_size=1))
+        db.session.refresh(u)
+        self.assertEqual(6.0, u.officalLeave)
+        self.assertEqual([LedgerType.OPENING, LedgerType.ADJUSTMENT], [e.type for e in u.ledger.order_by(LeaveLedger.id)])
+        self.assertAlmostEqual(u.officalLeave, sum(e.amount for e in u.ledger))
+
+    def test_review_digest(self):
+        self.app.config['FLASK_REVIEW_DIGEST_INTERVAL'] = 3600
+        reviewer = User(email='boss@example.com', username='boss', password='cat')
+        u = User(username='john', password='dog')
+        db.session.add_all([reviewer, u])
+        db.session.commit()
+        logs = [LeaveLog(start=datetime(2021, 4, d, 9), end=datetime(2021, 4, d, 18), reason='test',
+                         type_id=1, staff_id=u.id, agent_id=reviewer.id) for d in (6, 7, 8)]
+        db.session.add_all(logs)
+        db.session.commit()
+        with mail.record_messages() as outbox:
+            for l in logs:
+                l.notify_reviewer(reviewer)
+            db.session.commit()
+            self.assertEqual(0, LeaveLog.send_review_digests())
+            LeaveLog.query.filter_by(id=logs[0].id).update({'timestamp': datetime(2021, 4, 1)})
+            self.assertEqual(1, LeaveLog.send_review_digests())
+            self.assertEqual(0, LeaveLog.send_review_digests(force=True))
+            EmailQueue.get().shutdown()
+        self.assertEqual(1, len(outbox))
+        self.assertEqual(['boss@example.com'], outbox[0].recipients)
+        self.assertEqual(6, outbox[0].body.count('/reviewLeave/'))
+        self.assertTrue(all(l.notified is not None for l in LeaveLog.query))
+
+    def test_review_immediate(self):
+        reviewer = User(email='boss@example.com', username='boss', password='cat')
+        db.session.add(reviewer)
+        db.session.commit()
+        l = LeaveLog(start=datetime(2021, 4, 6, 9), end=datetime(2021, 4, 6, 18), type_id=1,
+                     staff_id=reviewer.id, agent_id=reviewer.id)
+        db.session.add(l)
+        db.session.commit()
+        with mail.record_messages() as outbox, self.app.test_request_context():
+            l.notify_reviewer(reviewer)
+            db.session.commit()
+            self.assertEqual(0, LeaveLog.send_review_digests(force=True))
+            EmailQueue.get().shutdown()
+        self.assertEqual(1, len(outbox))
+        self.assertTrue(l.notified is not None)
+
+    def test_review_many(self):
+        Role.insert_roles()
+        supervisor = User(username='boss', password='cat', department_id=1,
+                          role=Role.query.filter_by(name='Supervisor').first())
+        other = User(username='other', password='cat', department_id=2,
+                     role=Role.query.filter_by(name='Supervisor').first())
+        u = User(username='john', password='dog', department_id=1)
+        db.session.add_all([supervisor, other, u])
+        db.session.commit()
+        logs = [LeaveLog(start=datetime(2021, 4, d, 9), end=datetime(2021, 4, d, 18), type_id=1,
+                         department_id=1, staff_id=u.id) for d in range(5, 10)]
+        logs[0].reviewer_id = other.id
+        db.session.add_all(logs)
+        db.session.commit()
+        self.assertEqual(4, LeaveLog.review_queue(supervisor).count())
+        self.assertEqual(1, LeaveLog.review_queue(other).count())
+        ids = [l.id for l in logs]
+        statements = []
+        def before_execute(conn, clauseelement, multiparams, params):
+            statements.append(clauseelement)
+        db.event.listen(db.engine, 'before_execute', before_execute)
+        try:
+            self.assertEqual(4, LeaveLog.review_many(supervisor, ids, Status.TURN_DOWN))
+        finally:
+            db.event.remove(db.engine, 'before_execute', before_execute)
+        self.assertEqual(1, len(statements))
+        db.session.commit()
+        self.assertEqual([Status.UNDER_REVIEW] + [Status.TURN_DOWN] * 4,
+                         [LeaveLog.query.get(i).status for i in ids])
+        self.assertEqual(0, LeaveLog.review_many(supervisor, [], Status.AGREE))
+
+    def test_review_queue_excludes_own(self):
+        Role.insert_roles()
+        role = Role.query.filter_by(name='Supervisor').first()
+        supervisor = User(username='boss', password='cat', department_id=1, role=role)
+        deputy = User(username='deputy', password='cat', department_id=1, role=role)
+        u = User(username='john', password='dog', department_id=1)
+        db.session.add_all([supervisor, deputy, u])
+        db.session.commit()
+        own = LeaveLog(start=datetime(2021, 4, 5, 9), end=datetime(2021, 4, 5, 18), type_id=1,
+                       department_id=1, staff_id=supervisor.id)
+        staff = LeaveLog(start=datetime(2021, 4, 6, 9), end=datetime(2021, 4, 6, 18), type_id=1,
+                         department_id=1, staff_id=u.id)
+        db.session.add_all([own, staff])
+        db.session.commit()
+        self.assertEqual([staff], LeaveLog.review_queue(supervisor).all())
+        self.assertEqual([], LeaveLog.review_queue(deputy).all())
+        with self.app.test_request_context('/'):
+            self.assertEqual(0, LeaveLog.review_many(supervisor, [own.id], Status.AGREE))
+        self.assertEqual(Status.UNDER_REVIEW, own.status)
+
     # def test_update_status(self):
     #     u1 = User(password='cat')
     #     u2 = User(password='dog')
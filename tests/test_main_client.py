@@ -1,9 +1,10 @@
 import re
 import unittest
 from app import create_app, db
-from app.models import User, Role, LeaveType, Department, Gender, LeaveLog, Status
+from app.models import User, Role, LeaveType, Department, Gender, LeaveLog, Status, Post, Comment
 from datetime import datetime
 from flask import url_for
+from app.fragments import FragmentCache
 import time
 
 class MainClientTestCase(unittest.TestCase):
@@ -181,6 +182,33 @@ class MainClientTestCase(unittest.TestCase):
         self.assertTrue('結束時間' in response.get_data(as_text=True))
         self.assertTrue('請假原因' in response.get_data(as_text=True))
 
+    def test_ask_leave_overlap(self):
+        log = LeaveLog(start=datetime(2021, 5, 12, 9, 0, 0), end=datetime(2021, 5, 12, 18, 0, 0),
+                       reason='test', type_id=1, staff_id=self.user.id, agent_id=self.admin.id)
+        db.session.add(log)
+        db.session.commit()
+
+        # staff login
+        response = self.client.post('/auth/login', data={
+            'email': self.user.email,
+            'password': self.pw
+        })
+        self.assertEqual(response.status_code, 302)
+
+        response = self.client.post('/askLeave', data={
+            'leave_type': 1,
+            'agents': self.admin.id,
+            'startDate': '2021-05-11',
+            'startTime': '09:00',
+            'endDate': '2021-05-12',
+            'endTime': '12:00',
+            'reason': 'test'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('你的休假日期有重疊。' in response.get_data(as_text=True))
+        self.assertTrue(str(log.start) in response.get_data(as_text=True))
+        self.assertEqual(1, LeaveLog.query.count())
+
     def test_review_leave(self):
         log = LeaveLog(start=datetime(2021, 4, 10, 9, 0, 0), end=datetime(2021, 4, 10, 18, 0, 0),
                         duration=8.0, reason='test', type_id=1, staff_id=self.user.id, agent_id=self.admin.id)
@@ -205,6 +233,66 @@ class MainClientTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertTrue(log.status is Status.AGREE)
 
+    def test_pending_leave(self):
+        logs = [LeaveLog(start=datetime(2021, 4, d, 9, 0, 0), end=datetime(2021, 4, d, 18, 0, 0), reason='test',
+                         type_id=1, department_id=1, staff_id=self.user.id, agent_id=self.admin.id)
+                for d in (6, 7, 8)]
+        db.session.add_all(logs)
+        db.session.commit()
+
+        # staff login
+        response = self.client.post('/auth/login', data={
+            'email': self.user.email,
+            'password': self.pw
+        })
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get('/pendingLeave')
+        self.assertEqual(response.status_code, 403)
+        self.client.get('/auth/logout')
+
+        # admin login
+        response = self.client.post('/auth/login', data={
+            'email': self.admin.email,
+            'password': 'admin'
+        })
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get('/pendingLeave')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(3, response.get_data(as_text=True).count('name="ids"'))
+
+        response = self.client.post('/pendingLeave', data={
+            'ids': [logs[0].id, logs[1].id],
+            'agree': '同意'
+        }, follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('已更新 2 筆請假。' in response.get_data(as_text=True))
+        self.assertEqual(1, response.get_data(as_text=True).count('name="ids"'))
+        self.assertEqual([Status.AGREE, Status.AGREE, Status.UNDER_REVIEW],
+                         [LeaveLog.query.get(l.id).status for l in logs])
+
+    def test_work_or_holiday(self):
+        log = LeaveLog(start=datetime(2021, 4, 8, 9, 0, 0), end=datetime(2021, 4, 9, 18, 0, 0),
+                       reason='test', type_id=1, staff_id=self.user.id, agent_id=self.admin.id)
+        db.session.add(log)
+        db.session.commit()
+        self.assertEqual(16.0, log.duration)
+
+        # admin login
+        response = self.client.post('/auth/login', data={
+            'email': self.admin.email,
+            'password': 'admin'
+        })
+        self.assertEqual(response.status_code, 302)
+
+        response = self.client.post('/work_or_holiday', data={
+            'workday': 0,
+            'startDate': '2021-04-09',
+            'endDate': '2021-04-09',
+            'reason': 'typhoon'
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(8.0, LeaveLog.query.get(log.id).duration)
+
     def test_show_all_log(self):
         # not login
         response = self.client.get('/allLog')
@@ -240,6 +328,206 @@ class MainClientTestCase(unittest.TestCase):
         response = self.client.get('/leaveLog')
         self.assertEqual(response.status_code, 200)
 
+    def test_leave_log_pages(self):
+        self.app.config['FLASK_LEAVE_LOG_PER_PAGE'] = 2
+        for d in (6, 7, 8):
+            db.session.add(LeaveLog(start=datetime(2021, 4, d, 9, 0, 0), end=datetime(2021, 4, d, 18, 0, 0),
+                                    reason='reason{}'.format(d), type_id=1, staff_id=self.user.id))
+        db.session.commit()
+        response = self.client.post('/auth/login', data={
+            'email': self.user.email,
+            'password': self.pw
+        })
+        self.assertEqual(response.status_code, 302)
+
+        data = self.client.get('/leaveLog').get_data(as_text=True)
+        self.assertTrue('reason8' in data and 'reason7' in data and 'reason6' not in data)
+        self.assertTrue('顯示總筆數' in data)
+        cursor = re.findall(r'href="/leaveLog\?cursor=([^&"]+)"', data)
+        self.assertEqual(1, len(cursor))
+        data = self.client.get('/leaveLog?cursor={}&count=1'.format(cursor[0])).get_data(as_text=True)
+        self.assertTrue('reason6' in data and 'reason7' not in data)
+        self.assertTrue('共 3 筆' in data)
+
+    def test_query_budget(self):
+        users = [User(email='u{}@example.com'.format(i), username='u{}'.format(i), password='cat',
+                      department_id=i % 3 + 1) for i in range(24)]
+        db.session.add_all(users)
+        db.session.commit()
+        for i, u in enumerate(users):
+            post = Post(body='post {}'.format(i), author=u)
+            db.session.add(post)
+            db.session.add(Comment(body='comment', post=post, author=users[-i]))
+            db.session.add(LeaveLog(start=datetime(2021, 4, 6, 9, 0, 0), end=datetime(2021, 4, 6, 18, 0, 0),
+                                    type_id=i % 8 + 1, staff_id=u.id, agent_id=self.admin.id))
+        db.session.commit()
+        response = self.client.post('/auth/login', data={
+            'email': self.admin.email,
+            'password': 'admin'
+        })
+        self.assertEqual(response.status_code, 302)
+        self.client.set_cookie('localhost', 'log_status', '0')
+        self.client.set_cookie('localhost', 'edit_user_status', '1')
+        post_id = Post.query.first().id
+
+        def statements(url):
+            executed = []
+            def before_execute(conn, clauseelement, multiparams, params):
+                executed.append(clauseelement)
+            db.event.listen(db.engine, 'before_execute', before_execute)
+            try:
+                self.assertEqual(200, self.client.get(url).status_code)
+            finally:
+                db.event.remove(db.engine, 'before_execute', before_execute)
+            return len(executed)
+
+        urls = ['/', '/leaveLog', '/user/list', '/auth/edit-user', '/moderate', '/post/{}'.format(post_id)]
+        keys = ['FLASK_POSTS_PER_PAGE', 'FLASK_LEAVE_LOG_PER_PAGE', 'FLASK_USER_PER_PAGE', 'FLASK_COMMENTS_PER_PAGE']
+        self.app.config.update({k: 2 for k in keys})
+        for url in urls:
+            statements(url)
+        small = [statements(url) for url in urls]
+        self.app.config.update({k: 20 for k in keys})
+        large = [statements(url) for url in urls]
+        self.assertEqual(small, large)
+        self.assertTrue(all(n <= 5 for n in large), large)
+
+    def test_post_fragment_cache(self):
+        own = Post(body='mine', author=self.user)
+        other = Post(body='theirs', author=self.admin)
+        db.session.add_all([own, other])
+        db.session.commit()
+        response = self.client.post('/auth/login', data={
+            'email': self.user.email,
+            'password': self.pw
+        })
+        self.assertEqual(response.status_code, 302)
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertEqual(1, data.count('>Edit<'))
+        self.assertTrue('mine' in data and 'theirs' in data)
+        stats = FragmentCache.get().stats()
+        self.assertEqual((0, 2), (stats['hits'], stats['misses']))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertEqual(1, data.count('>Edit<'))
+        self.assertEqual(2, FragmentCache.get().stats()['hits'])
+
+        response = self.client.post('/edit/{}'.format(own.id), data={'body': 'edited'})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.post('/post/{}'.format(other.id), data={'body': 'a comment'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(2, FragmentCache.get().stats()['evictions'])
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertTrue('edited' in data and 'mine' not in data)
+        self.assertTrue('1 Comments' in data)
+        self.client.get('/auth/logout')
+
+        # 其他觀看者看到相同的快取區塊，但 Edit 標籤不同。
+        response = self.client.post('/auth/login', data={
+            'email': self.admin.email,
+            'password': 'admin'
+        })
+        self.assertEqual(response.status_code, 302)
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertEqual(1, data.count('>Edit<'))
+        self.assertEqual(1, data.count('>Edit [Admin]<'))
+        stats = self.client.get('/cache-stats').get_json()
+        self.assertEqual(0, stats['mail']['depth'])
+        self.assertTrue('avg_latency' in stats['mail'] and 'max_latency' in stats['mail'])
+        stats = stats['fragments']
+        self.assertEqual(4, stats['hits'])
+        self.assertEqual(4, stats['misses'])
+        self.assertEqual(0.5, stats['hit_rate'])
+
+    def test_conditional_get(self):
+        self.app.config['FLASK_LAST_SEEN_GRANULARITY'] = 60
+        post = Post(body='hello', author=self.user)
+        log = LeaveLog(start=datetime(2021, 4, 6, 9, 0, 0), end=datetime(2021, 4, 6, 18, 0, 0),
+                       reason='reason', type_id=1, staff_id=self.user.id, status=Status.UNDER_REVIEW)
+        db.session.add_all([post, log])
+        db.session.commit()
+        response = self.client.post('/auth/login', data={
+            'email': self.user.email,
+            'password': self.pw
+        })
+        self.assertEqual(response.status_code, 302)
+
+        for url in ['/', '/leaveLog', '/user/john', '/post/{}'.format(post.id)]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(b'', response.get_data())
+        # 只以 ETag 驗證，If-Modified-Since 不會得到 304。
+        response = self.client.get('/post/{}'.format(post.id))
+        self.assertFalse('Last-Modified' in response.headers)
+        response = self.client.get('/post/{}'.format(post.id),
+                                   headers={'If-Modified-Since': 'Sun, 01 Jan 2040 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+        # 資料異動後驗證值不同，重新渲染。
+        response = self.client.get('/leaveLog')
+        etag = response.headers['ETag']
+        log.status = Status.AGREE
+        db.session.commit()
+        response = self.client.get('/leaveLog', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('同意' in response.get_data(as_text=True))
+
+        response = self.client.get('/post/{}'.format(post.id))
+        etag = response.headers['ETag']
+        comment = Comment(body='a comment', post=post, author=self.admin)
+        db.session.add(comment)
+        db.session.commit()
+        response = self.client.get('/post/{}'.format(post.id), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        comment.disabled = True
+        db.session.commit()
+        response = self.client.get('/post/{}'.format(post.id), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        # 部門名稱也顯示在個人資料頁。
+        etag = self.client.get('/user/john').headers['ETag']
+        self.user.department.name = 'renamed'
+        db.session.commit()
+        response = self.client.get('/user/john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('renamed' in response.get_data(as_text=True))
+
+        # ETag 依觀看者而異。
+        etag = self.client.get('/user/john').headers['ETag']
+        self.client.get('/auth/logout')
+        response = self.client.post('/auth/login', data={
+            'email': self.admin.email,
+            'password': 'admin'
+        })
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get('/user/john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('john@example.com' in response.get_data(as_text=True))
+
+        # 作者、申請者與假別名稱改變時，首頁與請假紀錄重新渲染。
+        self.client.get('/allLog')
+        etags = {url: self.client.get(url).headers['ETag'] for url in ['/', '/leaveLog']}
+        self.user.username = 'johnny'
+        db.session.commit()
+        for url, etag in etags.items():
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200, url)
+            self.assertTrue('johnny' in response.get_data(as_text=True), url)
+        etag = self.client.get('/leaveLog').headers['ETag']
+        log.type.name = 'renamed type'
+        db.session.commit()
+        response = self.client.get('/leaveLog', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('renamed type' in response.get_data(as_text=True))
+
+        stats = self.client.get('/cache-stats').get_json()['conditional']
+        self.assertEqual(4, stats['not_modified'])
+        self.assertTrue(stats['bytes_saved'] > 0)
+        self.assertEqual(1, stats['endpoints']['main.user']['not_modified'])
+
     def test_show_self_log(self):
         # not login
         response = self.client.get('/selfLog')
@@ -88,4 +88,15 @@ class OfficalLeaveModelTestCase(unittest.TestCase):
             firstDay = datetime.strptime(f, fmt)
             self.assertEqual(a, OfficalLeave.newStaff(firstDay))
 
-    
\ No newline at end of file
+    
+
+    def test_new_year_cache(self):
+        firstDay = datetime.strptime('2009-04-16', '%Y-%m-%d')
+        before = OfficalLeave.cache_info()['newYear']
+        result = OfficalLeave.newYear(firstDay, 2031)
+        result.append(0)
+        self.assertEqual(3, len(OfficalLeave.newYear(firstDay, 2031)))
+        after = OfficalLeave.cache_info()['newYear']
+        self.assertEqual(before['misses'] + 1, after['misses'])
+        self.assertEqual(before['hits'] + 1, after['hits'])
+        self.assertTrue(after['size'] <= after['maxsize'])
@@ -0,0 +1,73 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import LeaveLog
+from app.pagination import KeysetPagination
+
+class PaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        # 每兩筆共用一個 timestamp，驗證以 id 區分同鍵值的資料列。
+        rows = [{'start': datetime(2021, 4, 6, 9), 'end': datetime(2021, 4, 6, 18), 'status': 1,
+                 'timestamp': datetime(2021, 1, 1) + timedelta(days=i // 2)} for i in range(25)]
+        db.session.execute(LeaveLog.__table__.insert(), rows)
+        db.session.commit()
+        self.keys = [(LeaveLog.timestamp, True), (LeaveLog.id, True)]
+        self.expected = [l.id for l in LeaveLog.query.order_by(LeaveLog.timestamp.desc(), LeaveLog.id.desc())]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_forward_and_back(self):
+        pages = []
+        p = KeysetPagination(LeaveLog.query, self.keys, 10)
+        self.assertFalse(p.has_prev)
+        while True:
+            pages.append(p)
+            if not p.has_next:
+                break
+            p = KeysetPagination(LeaveLog.query, self.keys, 10, cursor=p.next_cursor)
+        self.assertEqual([10, 10, 5], [len(p.items) for p in pages])
+        self.assertEqual(self.expected, [l.id for p in pages for l in p.items])
+        self.assertTrue(pages[-1].has_prev)
+
+        back = KeysetPagination(LeaveLog.query, self.keys, 10, cursor=pages[-1].prev_cursor)
+        self.assertEqual([l.id for l in pages[1].items], [l.id for l in back.items])
+        self.assertTrue(back.has_next and back.has_prev)
+        first = KeysetPagination(LeaveLog.query, self.keys, 10, cursor=back.prev_cursor)
+        self.assertEqual(self.expected[:10], [l.id for l in first.items])
+        self.assertFalse(first.has_prev)
+        self.assertTrue(first.has_next)
+
+    def test_ascending(self):
+        p = KeysetPagination(LeaveLog.query, [(LeaveLog.id, False)], 20)
+        p = KeysetPagination(LeaveLog.query, [(LeaveLog.id, False)], 20, cursor=p.next_cursor)
+        self.assertEqual([21, 22, 23, 24, 25], [l.id for l in p.items])
+        self.assertFalse(p.has_next)
+
+    def test_invalid_cursor(self):
+        for cursor in ['garbage', 'W10=', 'WyJuZXh0IiwgWzFdXQ==']:
+            p = KeysetPagination(LeaveLog.query, self.keys, 10, cursor=cursor)
+            self.assertEqual(self.expected[:10], [l.id for l in p.items])
+
+    def test_total_only_when_asked(self):
+        statements = []
+        def before_execute(conn, clauseelement, multiparams, params):
+            statements.append(clauseelement)
+        db.event.listen(db.engine, 'before_execute', before_execute)
+        try:
+            p = KeysetPagination(LeaveLog.query, self.keys, 10)
+            self.assertTrue(p.total is None)
+            self.assertEqual(1, len(statements))
+            p = KeysetPagination(LeaveLog.query, self.keys, 10, cursor=p.next_cursor, with_total=True)
+            self.assertEqual(25, p.total)
+            self.assertEqual(3, len(statements))
+            KeysetPagination(LeaveLog.query, self.keys, 10, cursor=p.next_cursor, with_total=True)
+            self.assertEqual(4, len(statements))
+        finally:
+            db.event.remove(db.engine, 'before_execute', before_execute)
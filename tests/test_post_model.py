@@ -0,0 +1,76 @@
+import unittest
+from unittest import mock
+from app import create_app, db
+from app.models import User, Role, Post, Comment, BodyRenderer
+
+class PostModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_comment_count(self):
+        p1 = Post(body='one', author=self.user)
+        p2 = Post(body='two', author=self.user)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(0, p1.comment_count)
+        comments = [Comment(body='c', post=p1, author=self.user) for i in range(3)]
+        db.session.add_all(comments)
+        db.session.commit()
+        self.assertEqual(3, p1.comment_count)
+        db.session.delete(comments[0])
+        comments[1].post = p2
+        db.session.flush()
+        self.assertEqual((1, 1), (p1.comment_count, p2.comment_count))
+        db.session.commit()
+        self.assertEqual((1, 1), (p1.comment_count, p2.comment_count))
+
+    def test_comment_count_with_new_post(self):
+        p = Post(body='one', author=self.user)
+        db.session.add(Comment(body='c', post=p, author=self.user))
+        db.session.commit()
+        self.assertEqual(1, db.session.query(Post.comment_count).filter_by(id=p.id).scalar())
+
+    def test_rebuild_comment_counts(self):
+        p = Post(body='one', author=self.user)
+        db.session.add_all([p, Comment(body='c', post=p, author=self.user)])
+        db.session.commit()
+        db.session.execute(Post.__table__.update().values(comment_count=5))
+        db.session.commit()
+        self.assertEqual(1, Post.rebuild_comment_counts())
+        self.assertEqual(0, Post.rebuild_comment_counts())
+        db.session.commit()
+        self.assertEqual(1, p.comment_count)
+
+    def test_rerender_bodies(self):
+        posts = [Post(body='# title {}'.format(i % 3), author=self.user) for i in range(10)]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.add(Comment(body='**bold**', post=posts[0], author=self.user))
+        db.session.commit()
+        self.assertEqual((10, 0), BodyRenderer.rerender(Post, chunk_size=4))
+        self.assertTrue(posts[0].body_html.startswith('<h1>'))
+
+        render = BodyRenderer.render
+        with mock.patch.object(Post, 'ALLOWED_TAGS', ['p']), \
+                mock.patch.object(BodyRenderer, 'render', side_effect=render) as counted:
+            self.assertEqual((10, 10), BodyRenderer.rerender(Post, chunk_size=4))
+            self.assertEqual(3, counted.call_count)
+        db.session.expire_all()
+        self.assertEqual('title 0', posts[0].body_html)
+        self.assertEqual((1, 0), BodyRenderer.rerender(Comment))
+
+        self.assertEqual((10, 10), BodyRenderer.rerender(Post, chunk_size=4, workers=2))
+        db.session.expire_all()
+        self.assertTrue(posts[0].body_html.startswith('<h1>'))
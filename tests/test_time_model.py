@@ -1,7 +1,7 @@
 import unittest
 from datetime import datetime, timedelta
 import calendar
-from app.models import Time
+from app.models import Time, WorkSchedule
 
 class TimeModelTestCase(unittest.TestCase):
     def setUp(self):
@@ -69,6 +69,34 @@ class TimeModelTestCase(unittest.TestCase):
         for start, end, a in l:
             self.assertEqual(a, Time.workingHours_day(start, end))
 
+    def test_work_schedule(self):
+        schedule = WorkSchedule.parse('07:00-15:00')
+        self.assertEqual(7*60*60, schedule.start)
+        self.assertEqual(15*60*60, schedule.end)
+        self.assertEqual(8*60*60, schedule.total)
+        l = [
+            ('07:00:00', '15:00:00', 8*60*60),
+            ('06:00:00', '09:30:00', 2.5*60*60),
+            ('14:00:00', '18:00:00', 1*60*60),
+        ]
+        for start, end, a in l:
+            self.assertEqual(a, Time.workingHours_day(start, end, schedule))
+        with self.assertRaises(AttributeError):
+            Time.workingHours_day('16:00:00', '18:00:00', schedule)
+
+    def test_invalid_work_schedule(self):
+        for text in ['22:00-06:00', '09:00-09:00', '09:00-12:00,11:00-18:00', '09:00-25:00', '09:00']:
+            with self.assertRaises(ValueError):
+                WorkSchedule.parse(text)
+        schedule = WorkSchedule.parse('22:00-24:00,00:00-06:00')
+        self.assertEqual(((0, 6*60*60), (22*60*60, 24*60*60)), schedule.segments)
+        self.assertEqual(8*60*60, schedule.total)
+
+    def test_default_work_schedule(self):
+        self.assertEqual(WorkSchedule.DEFAULT.segments, WorkSchedule.parse('09:00-12:00, 13:00-18:00').segments)
+        self.assertEqual(0, Time.workingHours_day('07:00:00', '08:00:00'))
+        self.assertEqual(0, Time.workingHours_day('12:10:00', '12:30:00'))
+
     def test_working_hours_in_day_time_range_check(self):
         l = [
             ('19:00:00', '18:00:00'),
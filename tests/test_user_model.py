@@ -2,7 +2,7 @@ import unittest
 import time
 from datetime import datetime
 from app import create_app, db
-from app.models import User, Role, Permission
+from app.models import User, Role, Permission, OfficalLeave, LastSeenBuffer, LeaveLedger, LedgerType, load_user
 
 class UserModelTestCase(unittest.TestCase):
     def setUp(self):
@@ -36,6 +36,30 @@ class UserModelTestCase(unittest.TestCase):
         u2 = User(password='cat')
         self.assertTrue(u.password_hash != u2.password_hash)
 
+    def test_password_rehash(self):
+        self.app.config['FLASK_PASSWORD_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(password='cat')
+        old = u.password_hash
+        self.assertTrue(old.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.verify_password('cat'))
+        self.assertEqual(old, u.password_hash)
+        self.app.config['FLASK_PASSWORD_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertFalse(u.verify_password('dog'))
+        self.assertEqual(old, u.password_hash)
+        self.assertTrue(u.verify_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.verify_password('cat'))
+        self.app.config['FLASK_PASSWORD_SALT_LENGTH'] = 32
+        self.assertTrue(u.verify_password('cat'))
+        self.assertEqual(32, len(u.password_hash.split('$')[1]))
+
+    def test_password_process_pool(self):
+        self.app.config['FLASK_PASSWORD_WORKERS'] = 1
+        u = User(password='cat')
+        self.assertTrue(u.verify_password('cat'))
+        self.assertFalse(u.verify_password('dog'))
+        self.app.extensions.pop('password_pool').shutdown()
+
     def test_valid_reset_token(self):
         u = User(password='cat')
         db.session.add(u)
@@ -121,6 +145,56 @@ class UserModelTestCase(unittest.TestCase):
         u.ping()
         self.assertTrue(u.last_seen > last_seen_before)
 
+    def test_ping_buffered(self):
+        self.app.config['FLASK_LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        self.app.config['FLASK_LAST_SEEN_GRANULARITY'] = 60
+        u = User(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        stored = lambda: db.session.execute(db.select([User.__table__.c.last_seen])
+                                            .where(User.__table__.c.id == u.id)).scalar()
+        last_seen_before = stored()
+        u.ping()
+        self.assertEqual(last_seen_before, u.last_seen)
+        u.last_seen = datetime(2021, 1, 1)
+        db.session.commit()
+        u.ping()
+        self.assertTrue(u.last_seen > datetime(2021, 1, 1))
+        self.assertEqual(datetime(2021, 1, 1), stored())
+        self.assertEqual(1, LastSeenBuffer.get().flush())
+        self.assertEqual(u.last_seen, stored())
+        self.assertEqual(0, LastSeenBuffer.get().flush())
+
+    def test_user_loader_cache(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+        statements = []
+        def before_execute(conn, clauseelement, multiparams, params):
+            statements.append(clauseelement)
+        db.event.listen(db.engine, 'before_execute', before_execute)
+        try:
+            self.assertEqual(user_id, load_user(str(user_id)).id)
+            misses = len(statements)
+            db.session.remove()
+            u = load_user(str(user_id))
+            self.assertTrue(u.can(Permission.WRITE))
+            self.assertFalse(u.is_administrator())
+            self.assertEqual('john@example.com', u.email)
+            self.assertEqual(misses, len(statements))
+        finally:
+            db.event.remove(db.engine, 'before_execute', before_execute)
+
+        u.email = 'susan@example.org'
+        u.role = Role.query.filter_by(name='Administrator').first()
+        db.session.commit()
+        db.session.remove()
+        u = load_user(str(user_id))
+        self.assertEqual('susan@example.org', u.email)
+        self.assertTrue(u.is_administrator())
+
     def test_gravatar(self):
         u = User(email='john@example.com', password='cat')
         with self.app.test_request_context('/'):
@@ -132,4 +206,48 @@ class UserModelTestCase(unittest.TestCase):
                         'd4c74594d841139328695756648b6bd6'in gravatar)
         self.assertTrue('s=256' in gravatar_256)
         self.assertTrue('r=pg' in gravatar_pg)
-        self.assertTrue('d=retro' in gravatar_retro)
\ No newline at end of file
+        self.assertTrue('d=retro' in gravatar_retro)
+
+    def test_rollover_leave(self):
+        l = [datetime(2020, 2, 29), datetime(2009, 4, 16), datetime(2022, 3, 1)]
+        users = []
+        for firstDay in l:
+            u = User(password='cat')
+            u.firstDay = firstDay
+            u.off_leave_start = datetime(2021, 1, 1)
+            u.officalLeave = 1.0
+            users.append(u)
+        db.session.add_all(users)
+        db.session.commit()
+
+        diff = User.rollover_leave(2022, chunk_size=1, dry_run=True)
+        self.assertEqual(2, len(diff))
+        self.assertEqual([1.0, 1.0, 1.0], [u.officalLeave for u in users])
+
+        self.assertEqual(2, len(User.rollover_leave(2022, chunk_size=1)))
+        for u, firstDay in zip(users[:2], l):
+            db.session.refresh(u)
+            self.assertEqual(OfficalLeave.newYear(firstDay, 2022), [u.off_leave_start, u.off_leave_end, u.officalLeave])
+        db.session.refresh(users[2])
+        self.assertEqual(1.0, users[2].officalLeave)
+
+        users[0].officalLeave = 3.0
+        db.session.commit()
+        self.assertEqual([], User.rollover_leave(2022))
+        self.assertEqual(3.0, users[0].officalLeave)
+
+    def test_rollover_leave_ledger(self):
+        u = User(password='cat')
+        u.firstDay = datetime(2009, 4, 16)
+        u.off_leave_start = datetime(2021, 1, 1)
+        u.officalLeave = 1.5
+        db.session.add(u)
+        db.session.commit()
+        u.ledger.delete()
+        db.session.commit()
+        self.assertEqual(1, len(User.rollover_leave(2022)))
+        db.session.refresh(u)
+        self.assertEqual(OfficalLeave.newYear(u.firstDay, 2022)[2], u.officalLeave)
+        entries = u.ledger.order_by(LeaveLedger.id).all()
+        self.assertEqual([LedgerType.OPENING, LedgerType.ACCRUAL], [e.type for e in entries])
+        self.assertAlmostEqual(u.officalLeave, sum(e.amount for e in entries))
@@ -0,0 +1,157 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import WorkOrHoliday, WorkCalendar, Time
+
+class WorkOrHolidayModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count_queries(self, f, *args):
+        statements = []
+        def before_execute(conn, clauseelement, multiparams, params):
+            statements.append(clauseelement)
+        db.event.listen(db.engine, 'before_execute', before_execute)
+        try:
+            result = f(*args)
+        finally:
+            db.event.remove(db.engine, 'before_execute', before_execute)
+        return result, len(statements)
+
+    def test_weekend(self):
+        self.assertFalse(WorkOrHoliday.not_workday(datetime(2021, 4, 9)))
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 4, 10)))
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 4, 11)))
+
+    def test_holiday_and_make_up_workday(self):
+        db.session.add(WorkOrHoliday(start=datetime(2021, 4, 1, 0, 0, 0), end=datetime(2021, 4, 2, 23, 59, 59),
+                                     reason='holiday', workday=0))
+        db.session.add(WorkOrHoliday(start=datetime(2021, 4, 10, 0, 0, 0), end=datetime(2021, 4, 10, 23, 59, 59),
+                                     reason='make up', workday=1))
+        db.session.commit()
+        self.assertFalse(WorkOrHoliday.not_workday(datetime(2021, 3, 31)))
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 4, 1)))
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 4, 2)))
+        self.assertFalse(WorkOrHoliday.not_workday(datetime(2021, 4, 10)))
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 4, 11)))
+
+    def test_event_across_years(self):
+        db.session.add(WorkOrHoliday(start=datetime(2020, 12, 31, 0, 0, 0), end=datetime(2021, 1, 1, 23, 59, 59),
+                                     reason='holiday', workday=0))
+        db.session.commit()
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2020, 12, 31)))
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 1, 1)))
+        self.assertFalse(WorkOrHoliday.not_workday(datetime(2021, 1, 4)))
+
+    def test_invalidate_on_insert(self):
+        self.assertFalse(WorkOrHoliday.not_workday(datetime(2021, 4, 1)))
+        db.session.add(WorkOrHoliday(start=datetime(2021, 4, 1, 0, 0, 0), end=datetime(2021, 4, 1, 23, 59, 59),
+                                     reason='holiday', workday=0))
+        db.session.commit()
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 4, 1)))
+
+    def test_no_queries_when_cached(self):
+        start = datetime(2021, 4, 1, 10, 30, 0)
+        end = datetime(2021, 4, 30, 10, 0, 0)
+        # 第一次另需查詢版本戳記 (含最長事件長度)。
+        seconds, count = self.count_queries(Time.workingHours_days, start, end)
+        self.assertEqual(2, count)
+        self.assertEqual(seconds, self.count_queries(Time.workingHours_days, start, end)[0])
+        self.assertEqual(0, self.count_queries(Time.workingHours_days, start, end)[1])
+        WorkCalendar.invalidate()
+        self.assertEqual(1, self.count_queries(Time.workingHours_days, start, end)[1])
+
+    def test_invalidate_on_other_worker(self):
+        # 兩個 app 共用同一個資料庫檔，模擬兩個 worker 行程。
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        workers = []
+        for i in range(2):
+            app = create_app('testing')
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+            workers.append(app)
+        def run(app, f):
+            with app.app_context():
+                try:
+                    return f()
+                finally:
+                    db.session.remove()
+        run(workers[0], db.create_all)
+        self.assertFalse(run(workers[0], lambda: WorkOrHoliday.not_workday(datetime(2021, 4, 1))))
+        def add():
+            db.session.add(WorkOrHoliday(start=datetime(2021, 4, 1, 0, 0, 0), end=datetime(2021, 4, 1, 23, 59, 59),
+                                         reason='holiday', workday=0))
+            db.session.commit()
+        run(workers[1], add)
+        self.assertTrue(run(workers[0], lambda: WorkOrHoliday.not_workday(datetime(2021, 4, 1))))
+        self.assertTrue(run(workers[1], lambda: WorkOrHoliday.not_workday(datetime(2021, 4, 1))))
+
+    def add_events(self, count, first=datetime(1990, 1, 1)):
+        rows = [{'start': first + timedelta(days=i*3), 'end': first + timedelta(days=i*3, hours=23, minutes=59),
+                 'reason': 'holiday', 'workday': 0} for i in range(count)]
+        db.session.execute(WorkOrHoliday.__table__.insert(), rows)
+        WorkOrHoliday.on_changed(None, db.session, None, longest=max(r['end'] - r['start'] for r in rows))
+        db.session.commit()
+
+    def test_find_overlapping(self):
+        self.add_events(10, datetime(2021, 4, 1))
+        l = [
+            (datetime(2021, 4, 1), datetime(2021, 4, 1), [datetime(2021, 4, 1)]),
+            (datetime(2021, 4, 1, 12), datetime(2021, 4, 2), [datetime(2021, 4, 1)]),
+            (datetime(2021, 4, 2), datetime(2021, 4, 3), []),
+            (datetime(2021, 4, 2), datetime(2021, 4, 7), [datetime(2021, 4, 4), datetime(2021, 4, 7)]),
+            (datetime(2021, 3, 1), datetime(2021, 3, 31), []),
+            (datetime(2021, 4, 28, 12), datetime(2021, 6, 1), [datetime(2021, 4, 28)]),
+        ]
+        for start, end, a in l:
+            self.assertEqual(a, [e.start for e in WorkOrHoliday.find_overlapping(start, end)
+                                                             .order_by(WorkOrHoliday.start)])
+        self.assertEqual(datetime(2021, 4, 4), WorkOrHoliday.covering(datetime(2021, 4, 4, 9)).start)
+        self.assertTrue(WorkOrHoliday.covering(datetime(2021, 4, 5)) is None)
+
+    def test_find_overlapping_legacy_overlaps(self):
+        # 早期資料可能有彼此重疊的事件。
+        week = WorkOrHoliday(start=datetime(2021, 4, 5), end=datetime(2021, 4, 9, 23, 59, 59), reason='week', workday=0)
+        day = WorkOrHoliday(start=datetime(2021, 4, 6), end=datetime(2021, 4, 6, 23, 59, 59), reason='day', workday=1)
+        db.session.add_all([week, day])
+        db.session.commit()
+        self.assertEqual([week], WorkOrHoliday.find_overlapping(datetime(2021, 4, 8), datetime(2021, 4, 8)).all())
+        self.assertEqual(week, WorkOrHoliday.covering(datetime(2021, 4, 6, 9)))
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 4, 8)))
+        self.assertTrue(WorkOrHoliday.not_workday(datetime(2021, 4, 6)))
+
+    def test_longest(self):
+        week = WorkOrHoliday(start=datetime(2021, 4, 5), end=datetime(2021, 4, 9, 23, 59, 59), reason='week', workday=0)
+        db.session.add(week)
+        db.session.add(WorkOrHoliday(start=datetime(2021, 4, 12), end=datetime(2021, 4, 12, 12), reason='day', workday=0))
+        db.session.commit()
+        longest, count = self.count_queries(WorkOrHoliday.longest)
+        self.assertEqual(timedelta(days=5, seconds=-1), longest)
+        self.assertEqual(1, count)
+        self.assertEqual(0, self.count_queries(WorkOrHoliday.longest)[1])
+        # 刪除事件不調小上限。
+        db.session.delete(week)
+        db.session.commit()
+        self.assertEqual(timedelta(days=5, seconds=-1), WorkOrHoliday.longest())
+        WorkOrHoliday.rebuild_longest()
+        db.session.commit()
+        self.assertEqual(timedelta(hours=12), WorkOrHoliday.longest())
+
+    def test_find_overlapping_uses_index(self):
+        query = WorkOrHoliday.find_overlapping(datetime(2021, 4, 1), datetime(2021, 4, 30))
+        statement = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plan = [str(r[-1]) for r in db.session.execute('EXPLAIN QUERY PLAN ' + statement)]
+        self.assertTrue(all('ix_work_or_holiday_start_end' in p for p in plan if 'work_or_holiday' in p))
+        # 範圍兩端都有界，掃描的筆數不隨資料量成長 (計時的量測見 app.bench.holiday_lookups)。
+        self.assertTrue(any('start>? AND start<?' in p for p in plan), plan)